@@ -1,8 +1,20 @@
+import time
 import traceback
-from flask import render_template, request, redirect, url_for
+import numpy as np
+import pandas as pd
+import sqlalchemy as sql
+from flask import render_template, request, redirect, url_for, jsonify
 import logging.config
 from flask import Flask
-from src.create_copa_db import COPA_Case_Attributes
+from src.case_codes import CaseCodec
+from src.db_engine import get_engine, pool_status
+from src.create_copa_db import COPA_Case_Attributes, COPA_Case_Codes, COPA_Outcome_Rollup, APP_COLUMN_MAP, \
+    ROLLUP_COLUMNS, read_data_version, read_levels, rollup_grouping_id
+from src.prediction_lookup import PredictionLookup
+from src.search_cache import SearchCache, normalize_selection
+from src.search_planner import SearchStats, apply_index_hint, choose_index, explain_query, table_indexes
+from src.tree_model import TreeModel
+from src.vocab import display_order, read_vocab
 from flask_sqlalchemy import SQLAlchemy
 
 
@@ -17,8 +29,55 @@ app.config.from_pyfile('config/flaskconfig.py')
 logging.config.fileConfig(app.config["LOGGING_CONFIG"])
 logger = logging.getLogger(app.config["APP_NAME"])
 
+class PooledSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy using the shared engine factory - pool sized by DB_POOL_* and read-only connections."""
+
+    def create_engine(self, sa_url, engine_opts):
+        engine_opts.pop("poolclass", None)
+        engine_opts.update(pool_size=app.config["DB_POOL_SIZE"], max_overflow=app.config["DB_MAX_OVERFLOW"],
+                           pool_timeout=app.config["DB_POOL_TIMEOUT"], pool_pre_ping=app.config["DB_POOL_PRE_PING"],
+                           pool_recycle=app.config["DB_POOL_RECYCLE"])
+        return get_engine(sa_url, read_only=app.config["DB_READ_ONLY"], **engine_opts)
+
+
 # Initialize the database
-db = SQLAlchemy(app)
+db = PooledSQLAlchemy(app)
+
+# Load the prediction lookup (memory-mapped) so fully-specified searches don't need the database
+try:
+    lookup = PredictionLookup.load(app.config["PRED_LOOKUP_LOCATION"])
+except Exception as e:
+    logger.warning("Prediction lookup not loaded, all searches will query the database: {}".format(e))
+    lookup = None
+
+# table of cases - with the "codes" schema attributes are stored as integer codes, translated by `codec` (read from
+# the database's copa_attribute_levels once per data version)
+case_model = COPA_Case_Codes if app.config["DB_SCHEMA"] == "codes" else COPA_Case_Attributes
+codec = None
+
+# search latencies and field usage, and the search indexes of the database (read on the first search)
+search_stats = SearchStats()
+search_indexes = None
+
+# results of recent searches, dropped when the database build stamps a new data version
+search_cache = SearchCache(app.config["SEARCH_CACHE_SIZE"], app.config["SEARCH_CACHE_TTL"])
+data_version = None
+data_version_checked = float("-inf")
+
+# values offered for each search field, loaded on first use (see search_options) - searches for other values are
+# rejected
+field_options = None
+field_options_version = None
+field_options_checked = float("-inf")
+
+# exported model, loaded on the first API request that needs probabilities the prediction lookup doesn't hold
+model = None
+
+@app.context_processor
+def inject_field_options():
+    """Values of each search field, for rendering the options of the search form."""
+    return {"options": search_options() or {}}
+
 
 @app.route('/')
 def index():
@@ -32,7 +91,8 @@ def index():
     """
 
     try:
-        cases = db.session.query(COPA_Case_Attributes).limit(5).all()
+        current_data_version()
+        cases = [case_record(case) for case in db.session.query(case_model).limit(5).all()]
         logger.debug("Index page accessed")
         messages = ["Showing: Example predictions"]
         return render_template('index.html', cases=cases, messages=messages)
@@ -42,6 +102,17 @@ def index():
         return render_template('error.html')
 
 
+# searchable fields (columns of copa_case_attributes) and how they are described to users
+FIELD_LIST = ["police_shooting", "race_complainants", "sex_complainants", "age_complainants",
+              "race_officers","sex_involved_officers", "age_officers", "excessive_force",
+              "years_on_force_officers"]
+FIELD_LABEL = {"police_shooting":"Police shooting: ", "race_complainants":"Race of complainant: ", "sex_complainants": "Gender of complainant: ",
+               "age_complainants": "Age of complainant: ",
+               "race_officers": "Race of officer: ", "sex_involved_officers": "Gender of officer: ",
+               "age_officers": "Age of officer: ", "excessive_force": "Excessive force: ",
+               "years_on_force_officers": "Years on force of officer: "}
+
+
 @app.route('/search', methods=['GET','POST'])
 def search_for_outcome():
     """View that process a POST with new song input
@@ -52,37 +123,418 @@ def search_for_outcome():
         # matching input to variable: https://stackoverflow.com/questions/14105452/what-is-the-cause-of-the-bad-request-error-when-submitting-form-in-flask-applica
         req = request.form
         print(req)
-        query = db.session.query(COPA_Case_Attributes)
-        logger.info("Query initialized")
-        field_list = ["police_shooting", "race_complainants", "sex_complainants", "age_complainants",
-                    "race_officers","sex_involved_officers", "age_officers", "excessive_force",
-                    "years_on_force_officers"]
-        field_label = {"police_shooting":"Police shooting: ", "race_complainants":"Race of complainant: ", "sex_complainants": "Gender of complainant: ",
-                       "age_complainants": "Age of complainant: ",
-                      "race_officers": "Race of officer: ", "sex_involved_officers": "Gender of officer: ",
-                       "age_officers": "Age of officer: ", "excessive_force": "Excessive force: ",
-                      "years_on_force_officers": "Years on force of officer: "}
+        selection = normalize_selection(request.form, FIELD_LIST)
+        options = search_options() or {}
+        unseen = [FIELD_LABEL[f] + value for f, value in selection if f in options and value not in options[f]]
+        if unseen:
+            logger.info("Search rejected, values not seen in training: {}".format(", ".join(unseen)))
+            messages = ["No predictions: the model was not trained on - ", ". ".join(unseen) + "."]
+            return render_template('index.html', cases=[], messages=messages)
         messages = ["Showing: Predictions displayed based on selection - "]
-        detail = ""
-        # build query dynamically: https://stackoverflow.com/questions/37336520/sqlalchemy-dynamic-filter
-        # build query dynamically: https://stackoverflow.com/questions/7604967/sqlalchemy-build-query-filter-dynamically-from-dict
-        # get query attr rather than string: https://stackoverflow.com/questions/10251724/how-to-give-column-name-dynamically-from-string-variable-in-sql-alchemy-filter
-        for f in field_list:
-            if request.form[f]:
-                query = query.filter(getattr(COPA_Case_Attributes, f) == request.form[f])
-                detail = detail+field_label[f]+request.form[f]+". "
+        detail = "".join(FIELD_LABEL[f] + value + ". " for f, value in selection)
         if detail == "":
             detail = "None"
-        logger.info("Perform query")
-        cases = query.limit(app.config["MAX_ROWS"]).all()
-        logger.info("Query results: {}".format(cases))
+        fields = [f for f, value in selection]
+        logger.info("Search fields used: {}".format(", ".join(fields) or "None"))
+        start = time.perf_counter()
+        search_cache.set_version(current_data_version())
+        result = search_cache.get(selection)
+        if result is None:
+            result = find_cases(selection)
+            search_cache.put(selection, result)
+        else:
+            logger.info("Search served from cache")
+        cases, summary = result
+        search_stats.record(fields, 1000 * (time.perf_counter() - start))
+        cache_stats = search_cache.stats()
+        logger.info("Search took {:.1f} ms (p95 of last {} searches: {:.1f} ms, cache hit rate {:.0%}, {} entries, "
+                    "{:.1f} kB)".format(search_stats.latencies[-1], len(search_stats.latencies),
+                                        search_stats.percentile(95), cache_stats["hit_rate"], cache_stats["entries"],
+                                        cache_stats["bytes"] / 1e3))
+        logger.info("Query results: {}".format(summary or cases))
         messages.append(detail)
-        return render_template('index.html', cases=cases, messages = messages)
+        return render_template('index.html', cases=cases, summary=summary, messages = messages)
     except Exception as e:
         logger.error(e)
         logger.warning("Not able to display search, error page returned")
         return render_template('error.html')
 
 
+@app.route('/stats')
+def search_statistics():
+    """View with search cache and latency statistics.
+
+    :return: JSON with the search cache's hit rate and memory use, search latency percentiles and field usage
+    """
+    return jsonify({"cache": search_cache.stats(),
+                    "latency_ms": {"p50": search_stats.percentile(50), "p95": search_stats.percentile(95),
+                                   "searches": len(search_stats.latencies)},
+                    "field_usage": {", ".join(fields) or "None": n
+                                    for fields, n in search_stats.field_usage.most_common()}})
+
+
+@app.route('/pool')
+def connection_pool():
+    """View with the database connection pool's metrics, for sizing DB_POOL_SIZE and DB_MAX_OVERFLOW per worker.
+
+    :return: JSON with the pool's size, checked-out and idle connections, overflow, and checkout wait times
+    """
+    return jsonify(pool_status(db.engine))
+
+
+@app.route('/api/predict', methods=['POST'])
+def api_predict():
+    """API view scoring a batch of cases in one vectorized pass.
+
+    Takes a JSON array of cases, each an object with a value for every search field (as in the search form). Cases
+    are scored from the prediction lookup (probabilities from the lookup if it holds them, otherwise from the exported
+    model), from the exported model if the lookup is not loaded, or else from a tuple-IN query on the cases table.
+
+    :return: JSON with the class labels and a prediction per case (predicted outcome and class probabilities, or an
+        error if the case has missing or unseen values), with Server-Timing headers for parsing and scoring
+    """
+    start = time.perf_counter()
+    cases = request.get_json(silent=True)
+    if not isinstance(cases, list) or not all(isinstance(case, dict) for case in cases):
+        return jsonify({"error": "Request body must be a JSON array of cases"}), 400
+    if len(cases) > app.config["API_MAX_CASES"]:
+        return jsonify({"error": "At most {} cases per request".format(app.config["API_MAX_CASES"])}), 413
+    data = pd.DataFrame(cases, columns=FIELD_LIST)
+    parsed = time.perf_counter()
+
+    try:
+        if lookup is not None:
+            classes, labels, proba = score_from_lookup(data)
+        elif load_model() is not None:
+            classes, labels, proba = score_from_model(data)
+        else:
+            classes, labels, proba = score_from_db(data)
+    except Exception as e:
+        logger.error(e)
+        return jsonify({"error": "Cases could not be scored"}), 500
+    scored = time.perf_counter()
+
+    predictions = []
+    for i, label in enumerate(labels):
+        if label is None:
+            predictions.append({"pred_outcome": None, "error": "Missing or unseen values"})
+        elif proba is None:
+            predictions.append({"pred_outcome": label})
+        else:
+            predictions.append({"pred_outcome": label, "probabilities": dict(zip(classes, proba[i].tolist()))})
+    response = jsonify({"classes": classes, "predictions": predictions})
+    done = time.perf_counter()
+
+    response.headers["Server-Timing"] = "parse;dur={:.1f}, score;dur={:.1f}, total;dur={:.1f}".format(
+        1000 * (parsed - start), 1000 * (scored - parsed), 1000 * (done - start))
+    response.headers["X-Cases"] = str(len(cases))
+    logger.info("Scored {} cases in {:.1f} ms".format(len(cases), 1000 * (done - start)))
+    return response
+
+
+def score_from_lookup(data):
+    """Score cases from the prediction lookup, with probabilities from the lookup or the exported model.
+
+    :param data: dataframe of cases, with a column per search field
+    :return: class labels, predicted label of each case (None if not valid) and class probabilities of each case (None
+        if no probabilities are available)
+    """
+    records = data.rename(columns={APP_COLUMN_MAP[f]: f for f in lookup.features})
+    labels, valid = lookup.predict_many(records)
+    classes = lookup.classes.tolist()
+    if lookup.pred_proba is not None:
+        return classes, labels.tolist(), lookup.predict_proba_many(records)
+
+    proba = None
+    if load_model() is not None and valid.any():
+        proba = np.full((len(records), len(classes)), np.nan)
+        proba[valid] = model.predict_proba(records[valid])
+    return classes, labels.tolist(), proba
+
+
+def score_from_model(data):
+    """Score cases with the exported model.
+
+    :param data: dataframe of cases, with a column per search field
+    :return: class labels, predicted label of each case (None if not valid) and class probabilities of each case (NaN
+        if not valid)
+    """
+    records = data.rename(columns={APP_COLUMN_MAP[f]: f for f in model.features})
+    codes = model.level_codes(records)
+    valid = (codes >= 0).all(axis=1)
+    labels = np.full(len(records), None, dtype=object)
+    labels[valid] = model.predict_codes(codes[valid])
+    proba = np.full((len(records), len(model.classes)), np.nan)
+    proba[valid] = model.predict_proba_codes(codes[valid])
+    return model.classes.tolist(), labels.tolist(), proba
+
+
+def score_from_db(data):
+    """Score cases from the cases table, with one tuple-IN query per batch of API_DB_BATCH_SIZE cases.
+
+    :param data: dataframe of cases, with a column per search field
+    :return: class labels, predicted label of each case (None if not found) and None (no probabilities)
+    """
+    current_data_version()
+    columns = [getattr(case_model, f) for f in FIELD_LIST]
+    keys = [tuple(None if value is None else str(value) for value in case)
+            for case in data.astype(object).where(data.notna(), None).itertuples(index=False)]
+    if codec is not None:
+        keys = [tuple(codec.encode(f, value) for f, value in zip(FIELD_LIST, key)) for key in keys]
+    found = {}
+    batch_size = app.config["API_DB_BATCH_SIZE"]
+    for start in range(0, len(keys), batch_size):
+        query = db.session.query(*columns, case_model.pred_outcome) \
+            .filter(sql.tuple_(*columns).in_(set(keys[start:start + batch_size])))
+        found.update((tuple(row[:-1]), row[-1]) for row in query.all())
+    if codec is not None:
+        found = {key: codec.levels["pred_outcome"][pred] for key, pred in found.items()}
+    labels = [found.get(key) for key in keys]
+    return outcome_classes(), labels, None
+
+
+def outcome_classes():
+    """Outcomes the model predicts - the labels of the codes with the "codes" schema, otherwise the labels of TARGET in
+    the category vocabulary (VOCAB_LOCATION).
+
+    :return: sorted list of class labels
+    """
+    if codec is not None:
+        return list(codec.levels["pred_outcome"])
+    return read_vocab(app.config["VOCAB_LOCATION"])[app.config["TARGET"]]
+
+
+def load_model():
+    """Exported model, memory-mapped from MODEL_ARTIFACT_LOCATION on first use.
+
+    :return: TreeModel, or None if it can't be loaded
+    """
+    global model
+    if model is None:
+        try:
+            model = TreeModel.load(app.config["MODEL_ARTIFACT_LOCATION"], mmap=True)
+        except Exception as e:
+            logger.warning("Model not loaded, API predictions will not include probabilities: {}".format(e))
+    return model
+
+
+def find_cases(selection):
+    """Find the cases matching a search.
+
+    A fully-specified search is answered from the prediction lookup, a partial one with the distribution of predicted
+    outcomes from the roll-up table. Matching rows are only queried if the roll-up table has not been built.
+
+    :param selection: normalized search, tuple of (field, value) pairs
+    :return: list of matching cases (dicts of fields and predicted outcome), at most MAX_ROWS, and the outcome
+        distribution (list of dicts of predicted outcome, count and share, empty if not summarised)
+    """
+    if lookup is not None and len(selection) == len(FIELD_LIST):
+        logger.info("Fully-specified search, using prediction lookup")
+        return lookup_case(dict(selection)), []
+
+    summary = summarize_outcomes(selection)
+    if summary:
+        return [], summary
+
+    # build query dynamically: https://stackoverflow.com/questions/37336520/sqlalchemy-dynamic-filter
+    # build query dynamically: https://stackoverflow.com/questions/7604967/sqlalchemy-build-query-filter-dynamically-from-dict
+    # get query attr rather than string: https://stackoverflow.com/questions/10251724/how-to-give-column-name-dynamically-from-string-variable-in-sql-alchemy-filter
+    query = db.session.query(case_model)
+    logger.info("Query initialized")
+    for f, value in selection:
+        if codec is not None:
+            value = codec.encode(f, value)
+            if value is None:
+                return [], []
+        query = query.filter(getattr(case_model, f) == value)
+    index = plan_search([f for f, value in selection])
+    query = apply_index_hint(query, case_model, index, db.engine.dialect.name)
+    query = query.limit(app.config["MAX_ROWS"])
+    logger.info("Perform query using index {}".format(index))
+    if app.config["LOG_QUERY_PLANS"]:
+        logger.info("Query plan: {}".format(explain_query(db.session, query)))
+    return [case_record(case) for case in query.all()], []
+
+
+def case_record(case):
+    """Labels of a row of the cases table.
+
+    :param case: row of copa_case_attributes or copa_case_codes
+    :return: dict of column to label
+    """
+    record = {c.name: getattr(case, c.name) for c in case_model.__table__.columns}
+    return codec.decode(record) if codec is not None else record
+
+
+def summarize_outcomes(selection):
+    """Distribution of predicted outcomes over the combinations matching a search, from the roll-up table.
+
+    :param selection: normalized search, tuple of (field, value) pairs
+    :return: list of dicts of predicted outcome, count and share, most common first - empty if nothing matches or
+        the roll-up table has not been built
+    """
+    values = dict(selection)
+    query = db.session.query(COPA_Outcome_Rollup.pred_outcome, COPA_Outcome_Rollup.count) \
+        .filter(COPA_Outcome_Rollup.grouping_id == rollup_grouping_id(values))
+    for col in ROLLUP_COLUMNS:
+        column = getattr(COPA_Outcome_Rollup, col)
+        query = query.filter(column == values[col] if col in values else column.is_(None))
+    query = query.order_by(COPA_Outcome_Rollup.count.desc())
+    if app.config["LOG_QUERY_PLANS"]:
+        logger.info("Roll-up query plan: {}".format(explain_query(db.session, query)))
+    try:
+        rows = query.all()
+    except Exception as e:
+        logger.warning("Roll-up table not available, querying matching rows: {}".format(e))
+        db.session.rollback()
+        return []
+    total = sum(count for outcome, count in rows)
+    return [{"pred_outcome": outcome, "count": count, "share": count / total} for outcome, count in rows]
+
+
+def plan_search(fields):
+    """Choose the index that should serve a search.
+
+    :param fields: names of the fields the search filters on
+    :return: name of the most selective index for the fields, or None if no index applies
+    """
+    global search_indexes
+    if search_indexes is None:
+        search_indexes = table_indexes(db.engine, case_model.__tablename__)
+        logger.info("Search indexes: {}".format(search_indexes))
+    n_levels = None
+    if lookup is not None:
+        n_levels = {APP_COLUMN_MAP[f]: n for f, n in zip(lookup.features, lookup.sizes)}
+    return choose_index(fields, search_indexes, n_levels)
+
+
+def current_data_version():
+    """Data version stamped by the last database build, re-read at most every SEARCH_CACHE_VERSION_INTERVAL seconds.
+
+    When the version changes, the search indexes are re-read on the next search and, with the "codes" schema, the
+    labels of the codes are read again.
+
+    :return: version string, or the last known version if the database can't be read
+    """
+    global data_version, data_version_checked, codec, search_indexes
+    if time.monotonic() - data_version_checked > app.config["SEARCH_CACHE_VERSION_INTERVAL"]:
+        try:
+            with db.engine.connect() as conn:
+                version = read_data_version(conn)
+                if version != data_version or (case_model is COPA_Case_Codes and codec is None):
+                    search_indexes = None
+                    if case_model is COPA_Case_Codes:
+                        codec = CaseCodec(read_levels(conn))
+            data_version = version
+            data_version_checked = time.monotonic()
+        except Exception as e:
+            logger.warning("Could not read data version: {}".format(e))
+    return data_version
+
+
+def search_options():
+    """Values of each search field, loaded on first use.
+
+    They are reloaded when the database build stamps a new data version, and retried at most every
+    SEARCH_CACHE_VERSION_INTERVAL seconds while some fields have none (e.g. the database was not reachable).
+
+    :return: dict of field to its values in display order, or None if no source could be read
+    """
+    global field_options, field_options_version, field_options_checked
+    version = current_data_version()
+    incomplete = field_options is None or len(field_options) < len(FIELD_LIST)
+    if version != field_options_version or \
+            incomplete and time.monotonic() - field_options_checked > app.config["SEARCH_CACHE_VERSION_INTERVAL"]:
+        field_options = load_field_options()
+        field_options_version = version
+        field_options_checked = time.monotonic()
+    return field_options
+
+
+def load_field_options():
+    """Values of each search field, from the category vocabulary saved by the pipeline (VOCAB_LOCATION).
+
+    With the prediction lookup loaded, only the values the model was trained on are kept. Fields the vocabulary doesn't
+    hold (e.g. after a change of FEATURES) take their values from the prediction lookup, or else from the cases table.
+
+    :return: dict of field to its values in display order - fields no source holds are left out (and not checked) -
+        or None if no source could be read
+    """
+    trained = {}
+    if lookup is not None:
+        trained = {APP_COLUMN_MAP[f]: levels for f, levels in zip(lookup.features, lookup.levels)}
+    options = {}
+    try:
+        for feature, labels in read_vocab(app.config["VOCAB_LOCATION"]).items():
+            f = APP_COLUMN_MAP.get(feature)
+            if f in FIELD_LIST:
+                options[f] = [value for value in labels if f not in trained or value in trained[f]]
+    except Exception as e:
+        logger.warning("Vocabulary not loaded: {}".format(e))
+    for f in FIELD_LIST:
+        if f not in options and f in trained:
+            options[f] = trained[f]
+
+    missing = [f for f in FIELD_LIST if f not in options]
+    if missing:
+        try:
+            options.update(database_options(missing))
+        except Exception as e:
+            logger.warning("Search options of {} not read from the database: {}".format(", ".join(missing), e))
+            db.session.rollback()
+    if not options:
+        logger.warning("Search options not loaded, searches will not be checked")
+        return None
+    logger.info("Search options loaded for {} fields".format(len(options)))
+    return {f: display_order(options[f]) for f in FIELD_LIST if f in options}
+
+
+def database_options(fields):
+    """Values of search fields in the cases table.
+
+    :param fields: names of the fields
+    :return: dict of field to its values
+    """
+    current_data_version()
+    if case_model is COPA_Case_Codes:
+        if codec is None:
+            raise ValueError("labels of the coded columns could not be read")
+        return {f: codec.levels[f] for f in fields}
+    return {f: [value for value, in db.session.query(getattr(case_model, f)).distinct() if value is not None]
+            for f in fields}
+
+
+def prewarm_search_cache():
+    """Fill the search cache with the searches configured in SEARCH_CACHE_PREWARM."""
+    search_cache.set_version(current_data_version())
+    for form in app.config["SEARCH_CACHE_PREWARM"]:
+        selection = normalize_selection(form, FIELD_LIST)
+        search_cache.put(selection, find_cases(selection))
+    logger.info("Search cache pre-warmed with {} searches".format(len(app.config["SEARCH_CACHE_PREWARM"])))
+
+
+def lookup_case(form):
+    """Predict the outcome of a fully-specified search from the prediction lookup.
+
+    :param form: submitted search form with a value for every field
+    :return: list with one case (dict of fields and predicted outcome), or empty if a value was not seen in training
+    """
+    record = {feature: form[APP_COLUMN_MAP[feature]] for feature in lookup.features}
+    try:
+        pred_outcome = lookup.predict(record)
+    except KeyError:
+        return []
+    case = {APP_COLUMN_MAP[feature]: value for feature, value in record.items()}
+    case["pred_outcome"] = pred_outcome
+    return [case]
+
+
+with app.app_context():
+    try:
+        prewarm_search_cache()
+    except Exception as e:
+        logger.warning("Search cache not pre-warmed: {}".format(e))
+
+
 if __name__ == '__main__':
     app.run(debug=app.config["DEBUG"], port=app.config["PORT"], host=app.config["HOST"])
\ No newline at end of file
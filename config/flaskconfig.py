@@ -10,4 +10,45 @@ SQLALCHEMY_DATABASE_URI = os.environ.get("SQLALCHEMY_DATABASE_URI")
 
 HOST = "0.0.0.0"
 SQLALCHEMY_ECHO = False  # If true, SQL for queries made will be printed
-MAX_ROWS = 20
\ No newline at end of file
+# Connection pool of each app process (so a gunicorn deployment opens up to workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+# connections) - seconds to wait for a connection, whether to test connections before use, and seconds after which
+# connections are replaced. Pool metrics are served at /pool
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT = 30
+DB_POOL_PRE_PING = True
+DB_POOL_RECYCLE = 1800
+DB_READ_ONLY = True  # If true, the app's database connections are read-only
+MAX_ROWS = 20
+# Schema of the cases table, as built by the pipeline (DB_SCHEMA in config.yaml): "labels" (copa_case_attributes) or
+# "codes" (copa_case_codes, with the labels in copa_attribute_levels)
+DB_SCHEMA = "labels"
+# If true, the database's query plan for each search is logged - an extra EXPLAIN per search, for diagnostics only
+LOG_QUERY_PLANS = False
+
+# Search result cache - maximum number of searches cached, seconds a cached result is kept, and how often (seconds) to
+# check the data version stamped by the database build (a new version clears the cache)
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_TTL = 3600
+SEARCH_CACHE_VERSION_INTERVAL = 30
+# Searches to cache at startup (field: value, with fields as in the search form)
+SEARCH_CACHE_PREWARM = [{},
+                        {"police_shooting": "Yes"},
+                        {"police_shooting": "No"},
+                        {"excessive_force": "True"},
+                        {"excessive_force": "False"}]
+# Prediction lookup saved by the model pipeline (PRED_LOOKUP_LOCATION) - used to answer fully-specified searches
+PRED_LOOKUP_LOCATION = "models/pred_lookup.npy"
+# Category vocabulary saved by the model pipeline (VOCAB_SAVE_LOCATION) - the search form offers its values, and
+# searches for values the model was not trained on are rejected without querying the database
+VOCAB_LOCATION = "models/vocab.json"
+# Target column of the model (TARGET in config.yaml) - its labels in the vocabulary are the classes /api/predict returns
+# when scoring from the database
+TARGET = "FINDING_CODE"
+# Model exported by the model pipeline (MODEL_ARTIFACT_LOCATION) - memory-mapped by /api/predict for class
+# probabilities when the prediction lookup was saved without them, or to score cases when there is no lookup
+MODEL_ARTIFACT_LOCATION = "models/model_trees"
+
+# Prediction API - maximum number of cases per request, and number of cases per query when scoring from the database
+API_MAX_CASES = 10000
+API_DB_BATCH_SIZE = 1000
@@ -1,4 +1,5 @@
 import argparse
+import os
 import yaml
 import logging.config
 import s3fs
@@ -6,7 +7,9 @@ from config import py_config
 from src.acquire_copa_data import acquire_copa_data
 from src.clean_copa_data import clean_copa_data
 from src.train_copa_model import train_copa_model
-from src.create_copa_db import create_copa_db
+from src.create_copa_db import create_copa_db, loaded_data_version, rollback_copa_db
+from src.data_io import manifest_location
+from src.stage_cache import StageCache
 
 if __name__ == '__main__':
     # load configs
@@ -21,6 +24,10 @@ if __name__ == '__main__':
 
     # shout out Kris D on slack for the disable existing loggers thing
     logging.config.fileConfig(config["LOGGING_CONFIG"], disable_existing_loggers=False)
+    logger = logging.getLogger('run')
+
+    # stages whose inputs, config and code are unchanged since their last run are reused rather than run again
+    cache = StageCache(config["STAGE_CACHE_LOCATION"], enabled=config["STAGE_CACHE_FLAG"])
 
     # ACQUIRE DATA IF FLAG IS SET TO DO SO
     acquire_flag = config["ACQUIRE_FLAG"]
@@ -29,8 +36,19 @@ if __name__ == '__main__':
         url = config["RAW_DATA_LOCATION"]
         s3_bucket = config["S3_BUCKET_NAME"]
         s3_key = config["S3_KEY_NAME"]
+        stream = config["ACQUIRE_STREAM"]
+        chunk_size = config["ACQUIRE_CHUNK_SIZE"]
+        part_size = config["ACQUIRE_PART_SIZE"]
+        max_retries = config["ACQUIRE_MAX_RETRIES"]
+        local_path = config["ACQUIRE_LOCAL_PATH"]
+        conditional = config["ACQUIRE_CONDITIONAL"]
         # acquire
-        acquire_copa_data(url, s3_bucket, s3_key)
+        changed = acquire_copa_data(url, s3_bucket, s3_key, stream, chunk_size, part_size, max_retries, local_path,
+                                    conditional)
+        # stages reading the raw data are reused if nothing else they depend on has changed
+        if changed is False:
+            logger.info("Raw data unchanged since the last acquisition")
+            cache.mark_unchanged(local_path or "s3://{}/{}".format(s3_bucket, s3_key))
 
     # CLEAN DATA IF FLAG IS SET TO DO SO
     clean_flag = config["CLEAN_FLAG"]
@@ -39,34 +57,113 @@ if __name__ == '__main__':
         # get configuration for data cleaning
         raw_loc = config["DATA_TO_CLEAN"]
         clean_loc = config["CLEAN_SAVE_LOCATION"]
+        data_format = config["DATA_FORMAT"]
+        chunk_size = config["CLEAN_CHUNK_SIZE"]
+        columns = config["FEATURES"] + [config["TARGET"]]
+        date_format = config["COMPLAINT_DATE_FORMAT"]
+        vocab_loc = config["VOCAB_SAVE_LOCATION"]
         # clean
-        clean_copa_data(raw_loc, clean_loc)
+        cache.run_stage("clean", lambda: clean_copa_data(raw_loc, clean_loc, data_format, chunk_size, columns,
+                                                         date_format, vocab_loc),
+                        inputs=[raw_loc], config=config,
+                        keys=["DATA_TO_CLEAN", "CLEAN_SAVE_LOCATION", "DATA_FORMAT", "CLEAN_CHUNK_SIZE", "FEATURES",
+                              "TARGET", "COMPLAINT_DATE_FORMAT", "VOCAB_SAVE_LOCATION"],
+                        code=["src/clean_copa_data.py", "src/data_io.py", "src/vocab.py"],
+                        outputs=[clean_loc] + ([vocab_loc] if vocab_loc else []))
 
     # FIT MODEL IF FLAG IS SET TO DO SO
     model_flag = config["MODEL_FLAG"]
     if model_flag:
     # TRAIN MODEL
+        clean_loc = config["CLEAN_SAVE_LOCATION"]
         features = config["FEATURES"]
         target = config["TARGET"]
         split_random_state = config["SPLIT_RANDOM_STATE"]
         test_size = config["TEST_SIZE"]
         model_loc = config["MODEL_SAVE_LOCATION"]
+        artifact_loc = config["MODEL_ARTIFACT_LOCATION"]
         fit_random_state = config["FIT_RANDOM_STATE"]
         ov_acc_loc = config["OV_ACC_SAVE_LOCATION"]
         acc_loc = config["ACC_SAVE_LOCATION"]
         prev_loc = config["PREV_SAVE_LOCATION"]
         var_loc = config["VAR_SAVE_LOCATION"]
+        metrics_loc = config["METRICS_SAVE_LOCATION"]
+        eval_chunk_size = config["EVAL_CHUNK_SIZE"]
+        importance_loc = config["IMPORTANCE_SAVE_LOCATION"]
+        importance_repeats = config["IMPORTANCE_REPEATS"]
+        importance_workers = config["IMPORTANCE_WORKERS"]
+        runs_loc = config["RUNS_SAVE_LOCATION"]
+        backend = config["MODEL_BACKEND"]
+        search_flag = config["SEARCH_FLAG"]
+        search_grid = config["SEARCH_GRID"] if search_flag else None
+        search_cv = config["SEARCH_CV"]
+        search_halving = config["SEARCH_HALVING"]
+        search_jobs = config["SEARCH_JOBS"]
+        leaderboard_loc = config["LEADERBOARD_SAVE_LOCATION"]
+        vocab_loc = config["VOCAB_SAVE_LOCATION"]
         app_flag = config["APP_DATA_FLAG"]
         app_loc = config["APP_SAVE_LOCATION"]
-        train_copa_model(clean_loc, features, target, split_random_state, test_size,
-                         model_loc, fit_random_state, ov_acc_loc, acc_loc, prev_loc, var_loc, app_loc, app_flag)
+        app_chunk_size = config["APP_CHUNK_SIZE"]
+        lookup_loc = config["PRED_LOOKUP_LOCATION"]
+        lookup_proba = config["PRED_LOOKUP_PROBA"]
+        sparse = config["SPARSE_ENCODING"]
+        app_workers = config["APP_SCORING_WORKERS"]
+        data_format = config["DATA_FORMAT"]
+        outputs = [model_loc, ov_acc_loc, acc_loc, prev_loc, var_loc, metrics_loc]
+        if backend == "gradient_boosting":
+            outputs.append(os.path.join(artifact_loc, "meta.json"))
+        if search_flag:
+            outputs.append(leaderboard_loc)
+        if importance_loc:
+            outputs.append(importance_loc)
+        if app_flag:
+            outputs += [manifest_location(app_loc), lookup_loc]
+        cache.run_stage("model",
+                        lambda: train_copa_model(clean_loc, features, target, split_random_state, test_size,
+                                                 model_loc, fit_random_state, ov_acc_loc, acc_loc, prev_loc, var_loc,
+                                                 app_loc, app_flag, app_chunk_size, lookup_loc, lookup_proba, sparse,
+                                                 app_workers, data_format, artifact_loc, backend, runs_loc,
+                                                 search_grid, search_cv, search_halving, search_jobs, leaderboard_loc,
+                                                 vocab_loc, metrics_loc, eval_chunk_size, importance_loc,
+                                                 importance_repeats, importance_workers),
+                        inputs=[clean_loc] + ([vocab_loc] if vocab_loc else []), config=config,
+                        keys=["CLEAN_SAVE_LOCATION", "FEATURES", "TARGET", "SPLIT_RANDOM_STATE", "TEST_SIZE",
+                              "MODEL_SAVE_LOCATION", "MODEL_ARTIFACT_LOCATION", "FIT_RANDOM_STATE",
+                              "OV_ACC_SAVE_LOCATION", "ACC_SAVE_LOCATION", "PREV_SAVE_LOCATION", "VAR_SAVE_LOCATION",
+                              "APP_DATA_FLAG", "APP_SAVE_LOCATION", "APP_CHUNK_SIZE", "PRED_LOOKUP_LOCATION",
+                              "PRED_LOOKUP_PROBA", "SPARSE_ENCODING", "DATA_FORMAT", "MODEL_BACKEND", "SEARCH_FLAG",
+                              "SEARCH_GRID", "SEARCH_CV", "SEARCH_HALVING", "SEARCH_JOBS", "LEADERBOARD_SAVE_LOCATION",
+                              "VOCAB_SAVE_LOCATION", "METRICS_SAVE_LOCATION", "EVAL_CHUNK_SIZE",
+                              "IMPORTANCE_SAVE_LOCATION", "IMPORTANCE_REPEATS", "IMPORTANCE_WORKERS"],
+                        code=["src/train_copa_model.py", "src/data_io.py", "src/prediction_lookup.py",
+                              "src/tree_model.py", "src/vocab.py"],
+                        outputs=outputs)
+
+    # ROLL THE DATABASE BACK TO ITS PREVIOUS LOAD IF FLAG IS SET TO DO SO
+    if config["DB_ROLLBACK"]:
+        rollback_copa_db(py_config.SQLALCHEMY_DATABASE_URI)
+        # the tables no longer match the last build, so the next build must run
+        if cache.enabled:
+            cache.stages.pop("db", None)
+            cache.save()
 
     # BUILD DATABSE IF FLAG IS SET TO DO SO
-    db_flag = config["DB_FLAG"]
+    db_flag = config["DB_FLAG"] and not config["DB_ROLLBACK"]
     if db_flag:
         app_loc = config["APP_SAVE_LOCATION"]
         engine_string = py_config.SQLALCHEMY_DATABASE_URI
-        create_copa_db(engine_string, app_loc)
+        batch_size = config["DB_BATCH_SIZE"]
+        data_format = config["DATA_FORMAT"]
+        indexes = config["DB_INDEXES"]
+        rollup = config["DB_ROLLUP"]
+        schema = config["DB_SCHEMA"]
+        cache.run_stage("db", lambda: create_copa_db(engine_string, app_loc, batch_size, data_format, indexes, rollup,
+                                                     schema),
+                        inputs=[app_loc], config=dict(config, SQLALCHEMY_DATABASE_URI=engine_string),
+                        keys=["SQLALCHEMY_DATABASE_URI", "APP_SAVE_LOCATION", "DB_BATCH_SIZE", "DATA_FORMAT",
+                              "DB_INDEXES", "DB_ROLLUP", "DB_SCHEMA"],
+                        code=["src/create_copa_db.py", "src/data_io.py", "src/db_engine.py", "src/case_codes.py"],
+                        outputs=[], state=lambda: loaded_data_version(engine_string))
 
 
 
@@ -1,18 +1,52 @@
+import hashlib
+import json
+import os
+import time
 import requests
+from requests.exceptions import RequestException
 import boto3
+from botocore.exceptions import BotoCoreError, ClientError
 import logging
 
 logger = logging.getLogger('acquire-copa')
 
-def acquire_copa_data(url, s3_bucket, s3_key):
+# S3 multipart uploads require every part but the last to be at least 5 MB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# suffix of the file/key (next to the data) recording the ETag, Last-Modified and hash of the last acquired data
+STATE_SUFFIX = ".meta.json"
+
+def acquire_copa_data(url, s3_bucket, s3_key, stream=False, chunk_size=1024 * 1024, part_size=MIN_PART_SIZE,
+                      max_retries=3, local_path=None, conditional=False):
     """Read COPA data score records from URL and upload to S3 Bucket.
     Args:
         url (`str`): URL from which to request data.
         s3_bucket (`str`): Name of S3 bucket in which to store data.
         s3_key (`str`): Name of S3 key to label the data.
+        stream (`bool`, default False): Whether to stream the response straight into the destination chunk by chunk
+            (multipart upload to S3) instead of holding the whole dataset in memory.
+        chunk_size (`int`, default 1 MB): Number of bytes to read from the response at a time when streaming.
+        part_size (`int`, default 5 MB): Size of each multipart upload part when streaming.
+        max_retries (`int`, default 3): Number of times to retry a failed part upload when streaming.
+        local_path (`str`, default None): If given when streaming, write the data to this local file instead of S3.
+        conditional (`bool`, default False): When streaming, whether to skip storing the data if it is unchanged since
+            the last acquisition (checked with a conditional request, then by content hash).
     Returns:
-        None.
+        False if the data was unchanged and nothing was stored, None if the request failed, otherwise True.
     """
+    if stream:
+        if local_path:
+            sink = LocalFileSink(local_path)
+        else:
+            sink = S3MultipartSink(s3_bucket, s3_key, part_size, max_retries)
+        previous = sink.read_state() if conditional else None
+        state = stream_copa_data(url, sink, chunk_size, previous)
+        if state is None:
+            return None
+        # saved even if the data is unchanged, so the next request is made with the latest ETag/Last-Modified
+        sink.write_state(state)
+        return state["changed"]
+
     # request data
     data = pull_copa_data(url)
 
@@ -20,6 +54,179 @@ def acquire_copa_data(url, s3_bucket, s3_key):
     if data is not None:
         # get S3 bucket and key from configs and upload
         put_in_S3(data, s3_bucket, s3_key)
+        return True
+
+def stream_copa_data(url, sink, chunk_size=1024 * 1024, previous=None):
+    """Stream data from URL into a sink without holding the whole response in memory.
+
+    If the state of a previous acquisition is given, the request is made conditional on its ETag/Last-Modified, and
+    the data is discarded rather than stored if its hash matches the previous one.
+    Args:
+        url (str): URL from which to request data.
+        sink (LocalFileSink or S3MultipartSink): Destination for the data.
+        chunk_size (int, default 1 MB): Number of bytes to read from the response at a time.
+        previous (dict, default None): State of the previous acquisition, as returned by this function.
+
+    Returns:
+        State of the acquisition - dict with the response's `etag` and `last_modified`, the data's `sha256`, `bytes`
+        and `lines`, and whether it `changed` - or None if the request or the upload was unsuccessful.
+    """
+    headers = {}
+    if previous:
+        if previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+
+    try:
+        with requests.get(url, stream=True, headers=headers) as response:
+            if response.status_code == 304:
+                logger.info("Data unchanged since last acquisition (not modified) - nothing stored.")
+                return dict(previous, changed=False)
+            if response.status_code != 200:
+                logger.error("URL data request failed with status {}  - returning None.".format(response.status_code))
+                return None
+
+            start = time.perf_counter()
+            sha256 = hashlib.sha256()
+            n_bytes = 0
+            n_lines = 0
+            sink.open()
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                n_bytes += len(chunk)
+                n_lines += chunk.count(b"\n")
+                sha256.update(chunk)
+                sink.write(chunk)
+            if n_bytes == 0:
+                sink.abort()
+                logger.error("No data returned from URL despite successful response code - returning None.")
+                return None
+
+            state = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified"),
+                     "sha256": sha256.hexdigest(), "bytes": n_bytes, "lines": n_lines}
+            state["changed"] = not previous or previous.get("sha256") != state["sha256"]
+            if state["changed"]:
+                sink.close()
+            else:
+                sink.abort()
+                logger.info("Data unchanged since last acquisition (same content hash) - nothing stored.")
+
+            elapsed = time.perf_counter() - start
+            logger.info("Retrieved {} lines of data ({:.1f} MB in {:.1f}s, {:.1f} MB/s)".format(
+                n_lines, n_bytes / 1e6, elapsed, n_bytes / 1e6 / max(elapsed, 1e-9)))
+            return state
+
+    # if exception (request or upload unsuccessful), abort the partial upload, log error and return none
+    except Exception as e:
+        sink.abort()
+        logger.error("Streaming data request failed. Returning None.")
+        logger.error(e)
+        return None
+
+class LocalFileSink:
+    """Write streamed data to a local file (via a temporary file, so an aborted download leaves the old file intact)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def open(self):
+        self.file = open(self.path + ".part", "wb")
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.path + ".part", self.path)
+        self.file = None
+        logger.info("Data successfully written to {}".format(self.path))
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.path + ".part")
+            self.file = None
+
+    def read_state(self):
+        """State of the last acquisition stored next to the file, or None if there is none or it can't be read."""
+        try:
+            with open(self.path + STATE_SUFFIX) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("State of the last acquisition not read, downloading unconditionally: {}".format(e))
+            return None
+
+    def write_state(self, state):
+        with open(self.path + STATE_SUFFIX, "w") as f:
+            json.dump(state, f)
+
+class S3MultipartSink:
+    """Upload streamed data to S3 with a multipart upload, buffering at most one part in memory."""
+
+    def __init__(self, s3_bucket, s3_key, part_size=MIN_PART_SIZE, max_retries=3):
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.max_retries = max_retries
+        self.client = boto3.client("s3")
+        self.upload_id = None
+
+    def open(self):
+        self.upload_id = self.client.create_multipart_upload(Bucket=self.s3_bucket, Key=self.s3_key)["UploadId"]
+        self.parts = []
+        self.buffer = bytearray()
+
+    def write(self, chunk):
+        self.buffer += chunk
+        if len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def upload_part(self, body):
+        """Upload one part, retrying with exponential backoff."""
+        part_number = len(self.parts) + 1
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.client.upload_part(Bucket=self.s3_bucket, Key=self.s3_key, UploadId=self.upload_id,
+                                                   PartNumber=part_number, Body=body)
+                self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+                logger.debug("Uploaded part {} ({} bytes)".format(part_number, len(body)))
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning("Upload of part {} failed ({}), retrying".format(part_number, e))
+                time.sleep(2 ** attempt)
+
+    def close(self):
+        if self.buffer or not self.parts:
+            self.upload_part(bytes(self.buffer))
+        self.client.complete_multipart_upload(Bucket=self.s3_bucket, Key=self.s3_key, UploadId=self.upload_id,
+                                              MultipartUpload={"Parts": self.parts})
+        self.upload_id = None
+        logger.info("Data successfully placed in {} bucket in S3 with key {}".format(self.s3_bucket, self.s3_key))
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.s3_bucket, Key=self.s3_key, UploadId=self.upload_id)
+            self.upload_id = None
+
+    def read_state(self):
+        """State of the last acquisition stored next to the key, or None if there is none or it can't be read."""
+        try:
+            response = self.client.get_object(Bucket=self.s3_bucket, Key=self.s3_key + STATE_SUFFIX)
+            return json.loads(response["Body"].read())
+        except self.client.exceptions.NoSuchKey:
+            return None
+        except (BotoCoreError, ClientError, ValueError) as e:
+            logger.warning("State of the last acquisition not read, downloading unconditionally: {}".format(e))
+            return None
+
+    def write_state(self, state):
+        self.client.put_object(Bucket=self.s3_bucket, Key=self.s3_key + STATE_SUFFIX, Body=json.dumps(state))
 
 def pull_copa_data(url):
     """ Pull data from URL.
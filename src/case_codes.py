@@ -0,0 +1,30 @@
+import logging
+
+logger = logging.getLogger('case_codes')
+
+class CaseCodec:
+    """Translation between the labels of the case attributes and the small-integer codes stored in `copa_case_codes`.
+
+    Built once from `copa_attribute_levels` (see `create_copa_db.read_levels`), so searches filter on integer codes and
+    results are translated back to labels for display.
+    """
+
+    def __init__(self, levels):
+        self.levels = {col: list(labels) for col, labels in levels.items()}
+        self.codes = {col: {label: code for code, label in enumerate(labels)} for col, labels in self.levels.items()}
+        logger.info("Case codes loaded for {} columns".format(len(self.levels)))
+
+    def encode(self, column, label):
+        """Code of a label in a column, or None if the label is not in the data."""
+        return self.codes[column].get(label)
+
+    def decode(self, record):
+        """
+        Translate the coded columns of a record back to their labels.
+        Args:
+            record (dict): Values keyed by column - codes for the coded columns.
+
+        Returns:
+            dict with labels in place of codes (other columns unchanged).
+        """
+        return {col: self.levels[col][value] if col in self.levels else value for col, value in record.items()}
@@ -1,17 +1,34 @@
+import numpy as np
 import pandas as pd
 import logging
 import s3fs
+from src.data_io import TableWriter, table_format, write_table
+from src.vocab import apply_vocab, collect_vocab, save_vocab
 
 logger = logging.getLogger('clean_copa_data')
 
-def clean_copa_data(raw_loc, clean_loc):
+def clean_copa_data(raw_loc, clean_loc, data_format=None, chunk_size=None, columns=None, date_format=None,
+                    vocab_loc=None):
     """Read COPA data from location and clean it.
     Args:
         raw_loc (`str`): Location of raw data to be cleaned (expected to be in format compatible with "read_csv").
-        clean_loc(`str`): Location to save the cleaned data (CSV).
+        clean_loc(`str`): Location to save the cleaned data (CSV, Parquet or Feather).
+        data_format (`str`, default None): Format to save the cleaned data in ("csv", "parquet" or "feather") - taken
+            from the extension of `clean_loc` if None.
+        chunk_size (`int`, default None): Number of rows to read, clean and write at a time (see
+            `clean_copa_data_chunked`) - the whole file is cleaned at once if None.
+        columns (`list`, default None): The model's features and target - the only columns kept besides those
+            cleaning needs when cleaning in chunks, and the columns of the vocabulary.
+        date_format (`str`, default None): strftime format of COMPLAINT_DATE - only used when cleaning in chunks.
+        vocab_loc (`str`, default None): Filepath to save the category vocabulary of `columns` to (.json), which
+            training uses to read them as categoricals - not saved if None.
     Returns:
         None.
     """
+    if chunk_size:
+        clean_copa_data_chunked(raw_loc, clean_loc, chunk_size, columns, date_format, data_format, vocab_loc)
+        return
+
     # request data
     data = load_data(raw_loc)
 
@@ -21,10 +38,49 @@ def clean_copa_data(raw_loc, clean_loc):
     # featurize
     data = make_excessive_force(data)
 
+    # fix the categories of the features and target
+    if vocab_loc is not None:
+        vocab = collect_vocab(data, columns or [])
+        save_vocab(vocab_loc, vocab)
+        data = apply_vocab(data, vocab)
+
     # put data in S3
-    data.to_csv(clean_loc, index=False)
+    write_table(data, clean_loc, data_format)
     logger.info('Data written to file in {}'.format(clean_loc))
 
+def clean_copa_data_chunked(raw_loc, clean_loc, chunk_size, columns=None, date_format=None, data_format=None,
+                            vocab_loc=None):
+    """Read, clean and write COPA data a chunk of rows at a time, so memory use depends on the chunk size rather than
+    the size of the raw file.
+    Args:
+        raw_loc (`str`): Location of raw data to be cleaned (CSV).
+        clean_loc(`str`): Location to save the cleaned data (CSV, Parquet or Feather).
+        chunk_size (`int`): Number of raw rows per chunk.
+        columns (`list`, default None): Columns to keep besides those cleaning needs (see `load_data_chunks`).
+        date_format (`str`, default None): strftime format of COMPLAINT_DATE.
+        data_format (`str`, default None): Format to save the cleaned data in - taken from the extension of
+            `clean_loc` if None.
+        vocab_loc (`str`, default None): Filepath to save the category vocabulary of `columns` to, collected over the
+            cleaned rows of all chunks - not saved if None.
+    Returns:
+        None.
+    """
+    n_raw = 0
+    vocab = {}
+    # each chunk has its own categories, and a Feather file can only hold one dictionary per column
+    dictionary = table_format(clean_loc, data_format) != "feather"
+    with TableWriter(clean_loc, data_format, dictionary) as writer:
+        for chunk in load_data_chunks(raw_loc, chunk_size, columns, date_format):
+            n_raw += len(chunk)
+            chunk = make_excessive_force(drop_invalid(chunk))
+            vocab = collect_vocab(chunk, columns or [], vocab)
+            writer.write(chunk)
+            logger.debug("Cleaned {} raw rows, {} kept".format(n_raw, writer.rows))
+    logger.info("Data cleaned in chunks of {} rows - {} of {} rows kept, written to file in {}".format(
+        chunk_size, writer.rows, n_raw, clean_loc))
+    if vocab_loc is not None:
+        save_vocab(vocab_loc, vocab)
+
 def load_data(location):
     """
     Args:
@@ -41,10 +97,46 @@ def load_data(location):
     except Exception as e:
         logger.error(e)
 
+def load_data_chunks(location, chunk_size, columns=None, date_format=None):
+    """
+    Read raw COPA data in chunks, parsing only the columns needed.
+    Args:
+        location (`str`): Location of data - CSV format.
+        chunk_size (`int`): Number of rows per chunk.
+        columns (`list`, default None): Columns to read besides CLEAN_COLUMNS - columns not in the file (such as
+            EXCESSIVE_FORCE, which cleaning derives) are skipped.
+        date_format (`str`, default None): strftime format of COMPLAINT_DATE - inferred from each chunk if None.
+
+    Yields:
+        Dataframe of each chunk, with text columns as categoricals and COMPLAINT_DATE as datetimes (NaT where a date
+        doesn't match `date_format`) - raises ValueError if none of a chunk's dates match, as every row would be
+        dropped as too recent.
+    """
+    wanted = set(CLEAN_COLUMNS) | set(columns or [])
+    usecols = [col for col in pd.read_csv(location, nrows=0).columns if col in wanted]
+    dtype = {col: "category" for col in usecols if col != "COMPLAINT_DATE"}
+    logger.debug("Loading {} of the data's columns in chunks of {} rows".format(len(usecols), chunk_size))
+    for chunk in pd.read_csv(location, usecols=usecols, dtype=dtype, chunksize=chunk_size):
+        dates = pd.to_datetime(chunk["COMPLAINT_DATE"], format=date_format, errors="coerce",
+                               infer_datetime_format=date_format is None)
+        n_unparsed = (dates.isna() & chunk["COMPLAINT_DATE"].notna()).sum()
+        if n_unparsed and n_unparsed == chunk["COMPLAINT_DATE"].notna().sum():
+            raise ValueError("None of the {} dates of a chunk could be parsed (format {}) - check COMPLAINT_DATE_FORMAT"
+                             .format(n_unparsed, date_format))
+        if n_unparsed:
+            logger.warning("{} dates could not be parsed (format {}) - their rows are dropped as too recent".format(
+                n_unparsed, date_format))
+        chunk["COMPLAINT_DATE"] = dates
+        yield chunk
+
 
 def drop_invalid(data):
     """
     Drop rows which are not valid for analysis. Keep only COPA/IPRA cases of type "complaint" and status "closed" with single officer + complainant.
+
+    Every rule in DROP_RULES is evaluated as a boolean mask over the original dataframe and the rows kept by all of them
+    are selected in one step, so the data is copied once however many rules there are. COMPLAINT_DATE is parsed once
+    and passed to the rules.
     Args:
         data (datafrome): COPA data.
 
@@ -52,27 +144,90 @@ def drop_invalid(data):
         Cleaned dataframe which can be used for featurization and modeling.
     """
     try:
-        data = drop_too_recent(data)
-        data = drop_status_asst(data)
-        data = drop_nas(data)
-        data = drop_multiples(data)
-        data = complaints_only(data)
+        dates = pd.to_datetime(data['COMPLAINT_DATE'], infer_datetime_format=True)
+        keep_masks = np.column_stack([rule(data, dates).to_numpy(dtype=bool) for name, rule in DROP_RULES])
+        keep = np.flatnonzero(keep_masks.all(axis=1))
+        log_rule_drops(~keep_masks)
+        data = data.take(keep)
+        data['COMPLAINT_DATE'] = dates.take(keep)
         logger.info("Data clean - {} rows".format(len(data)))
         return data
     except Exception as e:
         logger.error(e)
 
+def log_rule_drops(drop_masks):
+    """
+    Helper function for drop_invalid - log how many rows each rule drops.
+    Args:
+        drop_masks (2d boolean array): Whether each row (row) is dropped by each rule in DROP_RULES (column).
+
+    Returns:
+        None.
+    """
+    n_rules_dropping = drop_masks.sum(axis=1)
+    for i, (name, rule) in enumerate(DROP_RULES):
+        dropped = drop_masks[:, i]
+        logger.info("Rule '{}' drops {} rows ({} dropped by this rule only)".format(
+            name, dropped.sum(), (dropped & (n_rules_dropping == 1)).sum()))
+    logger.info("Dropped {} rows in total".format((n_rules_dropping > 0).sum()))
+
+def keep_not_too_recent(data, dates=None):
+    """Rule for drop_invalid - keep rows with date before May 10 2020 (`dates` is COMPLAINT_DATE already parsed)."""
+    if dates is None:
+        dates = pd.to_datetime(data['COMPLAINT_DATE'], infer_datetime_format=True)
+    return dates < "2020-05-10"
+
+def keep_status_asst(data, dates=None):
+    """Rule for drop_invalid - keep closed rows owned by COPA/IPRA."""
+    return (data['ASSIGNMENT'] != "BIA") & (data['CURRENT_STATUS'] == "Closed")
+
+def keep_not_na(data, dates=None):
+    """Rule for drop_invalid - keep rows without missing complainant/officer data."""
+    return data[NA_COLUMNS].notna().all(axis=1)
+
+def keep_single(data, dates=None):
+    """Rule for drop_invalid - keep rows with a single officer, complainant and finding."""
+    # values for multiple people/findings are separated with "|"
+    keep = pd.Series(True, index=data.index)
+    for col in MULTIPLE_COLUMNS:
+        keep &= ~data[col].str.contains("|", regex=False, na=False)
+    return keep
+
+def keep_complaints(data, dates=None):
+    """Rule for drop_invalid - keep rows of complaint type."""
+    return data['CASE_TYPE'] == "Complaint"
+
+# columns which must not be missing
+NA_COLUMNS = ['RACE_OF_COMPLAINANTS', 'SEX_OF_COMPLAINANTS', 'AGE_OF_COMPLAINANTS',
+              'RACE_OF_INVOLVED_OFFICERS', 'SEX_OF_INVOLVED_OFFICERS',
+              'AGE_OF_INVOLVED_OFFICERS', 'YEARS_ON_FORCE_OF_INVOLVED_OFFICERS', 'FINDING_CODE']
+
+# columns which must hold a single value
+MULTIPLE_COLUMNS = ['RACE_OF_COMPLAINANTS', 'RACE_OF_INVOLVED_OFFICERS', 'FINDING_CODE']
+
+# columns read by load_data_chunks for the rules below and make_excessive_force
+CLEAN_COLUMNS = sorted(set(NA_COLUMNS + MULTIPLE_COLUMNS + ['COMPLAINT_DATE', 'ASSIGNMENT', 'CURRENT_STATUS',
+                                                            'CASE_TYPE', 'CURRENT_CATEGORY']))
+
+# rules applied by drop_invalid - (name, function of the data and its parsed COMPLAINT_DATE returning a boolean mask of
+# the rows to keep)
+DROP_RULES = [("too recent", keep_not_too_recent),
+              ("status and assignment", keep_status_asst),
+              ("NAs", keep_not_na),
+              ("multiples", keep_single),
+              ("non-complaints", keep_complaints)]
+
 def drop_too_recent(data):
     """Helper function for drop_invalid - drops rows with date after May 9 2020."""
     data['COMPLAINT_DATE'] = pd.to_datetime(data['COMPLAINT_DATE'], infer_datetime_format=True)
-    data = data[data['COMPLAINT_DATE'] < "2020-05-10"]
+    data = data[keep_not_too_recent(data)]
     return data
 
 def drop_status_asst(data):
     """Helper function for drop_invalid - drops rows with owner other than COPA/IPRA and status other than closed."""
     # keep only closed COPA/IPRA data
     before = len(data)
-    data = data[(data['ASSIGNMENT'] != "BIA") & (data['CURRENT_STATUS'] == "Closed")]
+    data = data[keep_status_asst(data)]
     after = len(data)
     logger.info("Dropped {} rows for status and assignment".format(before - after))
     return data
@@ -81,9 +236,7 @@ def drop_nas(data):
     """Helper function for drop_invalid - drop rows with missing data."""
     # drop NAs
     before = len(data)
-    data = data.dropna(subset=['RACE_OF_COMPLAINANTS', 'SEX_OF_COMPLAINANTS', 'AGE_OF_COMPLAINANTS',
-                               'RACE_OF_INVOLVED_OFFICERS', 'SEX_OF_INVOLVED_OFFICERS',
-                               'AGE_OF_INVOLVED_OFFICERS', 'YEARS_ON_FORCE_OF_INVOLVED_OFFICERS'])
+    data = data[keep_not_na(data)]
     after = len(data)
     logger.info("Dropped {} rows for NAs".format(before - after))
     return data
@@ -92,10 +245,7 @@ def drop_multiples(data):
     """Helper function for drop_invalid - drop rows with multiple officers or complainants."""
     # drop cases with multiple complainants or multiple officers
     before = len(data)
-    # https://stackoverflow.com/questions/27975069/how-to-filter-rows-containing-a-string-pattern-from-a-pandas-dataframe
-    data = data[~data['RACE_OF_COMPLAINANTS'].str.contains("\|")]
-    data = data[~data['RACE_OF_INVOLVED_OFFICERS'].str.contains("\|")]
-    data = data[~data['FINDING_CODE'].str.contains("\|")]
+    data = data[keep_single(data)]
     after = len(data)
     logger.info("Dropped {} rows for multiples".format(before - after))
     return data
@@ -119,7 +269,7 @@ def make_excessive_force(data):
 def complaints_only(data):
     """Helper function for drop_invalid - drop rows with non-complaint types."""
     before = len(data)
-    data = data[data['CASE_TYPE'] == "Complaint"]
+    data = data[keep_complaints(data)]
     after = len(data)
     logger.info("Dropped {} rows of non-complaints".format(before - after))
     return data
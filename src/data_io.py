@@ -0,0 +1,211 @@
+import json
+import logging
+import posixpath
+import fsspec
+import pandas as pd
+
+logger = logging.getLogger('data_io')
+
+# file extensions of the supported intermediate formats
+FORMAT_EXTENSIONS = {".csv": "csv", ".parquet": "parquet", ".pq": "parquet", ".feather": "feather",
+                     ".arrow": "feather"}
+
+def table_format(location, fmt=None):
+    """
+    Format of an intermediate dataset.
+    Args:
+        location (str): Filepath of the dataset.
+        fmt (str, default None): Format to use ("csv", "parquet" or "feather") - taken from the file extension if None.
+
+    Returns:
+        Name of the format. Files with an unrecognized extension are treated as CSV.
+    """
+    if fmt is not None:
+        return fmt
+    return FORMAT_EXTENSIONS.get(posixpath.splitext(location)[1].lower(), "csv")
+
+def read_table(location, columns=None, fmt=None, dtype=None):
+    """
+    Read an intermediate dataset, optionally only some of its columns.
+
+    Parquet and Feather are columnar, so only the requested columns are read from the file.
+    Args:
+        location (str): Filepath of the dataset.
+        columns (list, default None): Columns to read - all if None.
+        fmt (str, default None): Format of the dataset - taken from the file extension if None.
+        dtype (dict, default None): Types to parse CSV columns as, keyed by column (Parquet and Feather keep their
+            stored types).
+
+    Returns:
+        Dataframe of loaded data.
+    """
+    fmt = table_format(location, fmt)
+    if fmt == "parquet":
+        return pd.read_parquet(location, columns=columns)
+    if fmt == "feather":
+        return pd.read_feather(location, columns=columns)
+    # callable usecols skips unwanted columns without raising for missing ones, so callers selecting
+    # columns get the usual KeyError
+    return pd.read_csv(location, usecols=None if columns is None else lambda col: col in columns, dtype=dtype)
+
+def read_table_chunks(location, chunksize, fmt=None):
+    """
+    Read an intermediate dataset in chunks.
+    Args:
+        location (str): Filepath of the dataset.
+        chunksize (int): Maximum number of rows per chunk.
+        fmt (str, default None): Format of the dataset - taken from the file extension if None.
+
+    Yields:
+        Dataframes of at most `chunksize` rows.
+    """
+    fmt = table_format(location, fmt)
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        with fsspec.open(location, "rb") as f:
+            for batch in pq.ParquetFile(f).iter_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+    elif fmt == "feather":
+        import pyarrow as pa
+        with fsspec.open(location, "rb") as f:
+            reader = pa.ipc.open_file(f)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                for start in range(0, batch.num_rows, chunksize):
+                    yield batch.slice(start, chunksize).to_pandas()
+    else:
+        for chunk in pd.read_csv(location, chunksize=chunksize):
+            yield chunk
+
+def write_table(data, location, fmt=None):
+    """
+    Write an intermediate dataset.
+
+    For Parquet and Feather, string columns are stored dictionary-encoded (as pandas categoricals).
+    Args:
+        data (dataframe): Data to write.
+        location (str): Filepath to write to.
+        fmt (str, default None): Format to write - taken from the file extension if None.
+
+    Returns:
+        None.
+    """
+    with TableWriter(location, fmt) as writer:
+        writer.write(data)
+
+def dictionary_encode(data):
+    """Helper function for TableWriter - convert string (object) columns to categoricals."""
+    data = data.reset_index(drop=True)
+    for col in data.columns[data.dtypes == object]:
+        data[col] = data[col].astype("category")
+    return data
+
+def dictionary_decode(table):
+    """Helper function for TableWriter - convert the dictionary-encoded columns of an Arrow table to plain values."""
+    import pyarrow as pa
+    fields = [pa.field(f.name, f.type.value_type) if pa.types.is_dictionary(f.type) else f for f in table.schema]
+    return table.cast(pa.schema(fields, metadata=table.schema.metadata))
+
+class TableWriter:
+    """Write an intermediate dataset chunk by chunk (CSV appends, Parquet row groups or Arrow IPC record batches).
+
+    Use as a context manager; the schema of a Parquet/Feather file is fixed by the first chunk written. A Feather file
+    holds a single dictionary per column, so chunks whose categories differ must be written with `dictionary=False`,
+    which stores string and categorical columns as plain strings.
+    """
+
+    def __init__(self, location, fmt=None, dictionary=True):
+        self.location = location
+        self.fmt = table_format(location, fmt)
+        self.dictionary = dictionary
+        self.schema = None
+        self.writer = None
+        self.rows = 0
+
+    def __enter__(self):
+        self.file = fsspec.open(self.location, "w" if self.fmt == "csv" else "wb").open()
+        return self
+
+    def write(self, data):
+        """Append a chunk (dataframe) to the dataset."""
+        if self.fmt == "csv":
+            data.to_csv(self.file, index=False, header=(self.rows == 0))
+        else:
+            import pyarrow as pa
+            if self.dictionary:
+                table = pa.Table.from_pandas(dictionary_encode(data), schema=self.schema, preserve_index=False)
+            else:
+                table = dictionary_decode(pa.Table.from_pandas(data.reset_index(drop=True), preserve_index=False))
+                if self.schema is not None:
+                    table = table.cast(self.schema)
+            if self.writer is None:
+                self.schema = table.schema
+                if self.fmt == "parquet":
+                    import pyarrow.parquet as pq
+                    self.writer = pq.ParquetWriter(self.file, self.schema)
+                else:
+                    self.writer = pa.ipc.new_file(self.file, self.schema)
+            self.writer.write_table(table)
+        self.rows += len(data)
+
+    def __exit__(self, *exc):
+        if self.writer is not None:
+            self.writer.close()
+        self.file.close()
+
+def manifest_location(location):
+    """
+    Filepath of the manifest listing the part files of a (possibly partitioned) dataset.
+    Args:
+        location (str): Filepath of the dataset, e.g. APP_SAVE_LOCATION.
+
+    Returns:
+        Filepath of the manifest (same name with a `.manifest.json` extension).
+    """
+    return posixpath.splitext(location)[0] + ".manifest.json"
+
+def part_location(location, part):
+    """
+    Filepath of one part file of a partitioned dataset.
+    Args:
+        location (str): Filepath of the dataset, e.g. APP_SAVE_LOCATION.
+        part (int): Part number.
+
+    Returns:
+        Filepath of the part (dataset name with a `-part-<number>` suffix, same extension).
+    """
+    stem, ext = posixpath.splitext(location)
+    return "{}-part-{:05d}{}".format(stem, part, ext)
+
+def write_manifest(location, parts, rows):
+    """
+    Write the manifest of a dataset.
+    Args:
+        location (str): Filepath of the dataset.
+        parts (list of str): Filepaths of the part files, in row order.
+        rows (list of int): Number of rows in each part.
+
+    Returns:
+        None.
+    """
+    manifest = {"parts": [{"location": part, "rows": int(n)} for part, n in zip(parts, rows)],
+                "rows": int(sum(rows))}
+    with fsspec.open(manifest_location(location), "w") as f:
+        json.dump(manifest, f, indent=2)
+    logger.info("Manifest of {} parts written to {}".format(len(parts), manifest_location(location)))
+
+def dataset_parts(location):
+    """
+    Filepaths of the files making up a dataset, read from its manifest.
+    Args:
+        location (str): Filepath of the dataset.
+
+    Returns:
+        List of part filepaths in row order - just `location` if the dataset has no manifest.
+    """
+    try:
+        with fsspec.open(manifest_location(location), "r") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return [location]
+    return [part["location"] for part in manifest["parts"]]
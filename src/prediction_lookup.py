@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import numpy as np
+from src.vocab import level_codes
+
+logger = logging.getLogger('prediction_lookup')
+
+def lookup_paths(lookup_loc):
+    """
+    Filepaths of the files that make up a prediction lookup artifact.
+    Args:
+        lookup_loc (str): Filepath of the class-code array (.npy).
+
+    Returns:
+        Tuple of filepaths (class codes .npy, probabilities .npy, metadata .json).
+    """
+    stem = os.path.splitext(lookup_loc)[0]
+    return lookup_loc, stem + "_proba.npy", stem + ".json"
+
+def save_lookup(lookup_loc, features, levels, classes, pred_codes, pred_proba=None):
+    """
+    Save a prediction lookup artifact.
+    Args:
+        lookup_loc (str): Filepath to save the class-code array (.npy); metadata and probabilities are saved next to it.
+        features (list): Feature names, in combination-id order.
+        levels (list of lists): Category levels of each feature.
+        classes (list): Class labels, indexed by class code.
+        pred_codes (1d array): Predicted class code of each combination, indexed by combination id.
+        pred_proba (2d array, default None): Predicted class probabilities of each combination, if they are to be saved.
+
+    Returns:
+        None.
+    """
+    codes_loc, proba_loc, meta_loc = lookup_paths(lookup_loc)
+    np.save(codes_loc, pred_codes)
+    if pred_proba is not None:
+        np.save(proba_loc, pred_proba)
+    meta = {"features": list(features),
+            "levels": [[str(lev) for lev in feature_levels] for feature_levels in levels],
+            "classes": [str(c) for c in classes],
+            "proba": pred_proba is not None}
+    with open(meta_loc, "w") as f:
+        json.dump(meta, f)
+    logger.info("Prediction lookup for {} combinations saved to {}".format(len(pred_codes), codes_loc))
+
+class PredictionLookup:
+    """Predicted class (and optionally probabilities) of every combination of feature levels, addressed by combination id.
+
+    The combination id is the mixed-radix number whose digits are the category codes of each feature (the first
+    feature varies slowest), the same ordering used to generate the unique-combination data in training.
+    """
+
+    def __init__(self, features, levels, classes, pred_codes, pred_proba=None):
+        self.features = list(features)
+        self.levels = [list(feature_levels) for feature_levels in levels]
+        self.classes = np.asarray(classes, dtype=object)
+        self.pred_codes = pred_codes
+        self.pred_proba = pred_proba
+        self.sizes = [len(feature_levels) for feature_levels in self.levels]
+        self.codes = [{lev: i for i, lev in enumerate(feature_levels)} for feature_levels in self.levels]
+
+    @classmethod
+    def load(cls, lookup_loc, mmap=True):
+        """
+        Load a prediction lookup artifact saved with `save_lookup`.
+        Args:
+            lookup_loc (str): Filepath of the class-code array (.npy).
+            mmap (bool, default True): Whether to memory-map the arrays rather than read them into memory.
+
+        Returns:
+            PredictionLookup.
+        """
+        codes_loc, proba_loc, meta_loc = lookup_paths(lookup_loc)
+        with open(meta_loc) as f:
+            meta = json.load(f)
+        mmap_mode = "r" if mmap else None
+        pred_codes = np.load(codes_loc, mmap_mode=mmap_mode)
+        pred_proba = np.load(proba_loc, mmap_mode=mmap_mode) if meta["proba"] else None
+        logger.info("Prediction lookup for {} combinations loaded from {}".format(len(pred_codes), codes_loc))
+        return cls(meta["features"], meta["levels"], meta["classes"], pred_codes, pred_proba)
+
+    def __len__(self):
+        return len(self.pred_codes)
+
+    def combination_id(self, record):
+        """
+        Combination id of a fully-specified input.
+        Args:
+            record (dict): Level of every feature, keyed by feature name.
+
+        Returns:
+            Integer combination id. Raises KeyError if a feature is missing or a level was not seen in training.
+        """
+        combination_id = 0
+        for feature, size, codes in zip(self.features, self.sizes, self.codes):
+            combination_id = combination_id * size + codes[str(record[feature])]
+        return combination_id
+
+    def predict(self, record):
+        """
+        Predicted class of a fully-specified input.
+        Args:
+            record (dict): Level of every feature, keyed by feature name.
+
+        Returns:
+            Predicted class label.
+        """
+        return self.classes[self.pred_codes[self.combination_id(record)]]
+
+    def predict_proba(self, record):
+        """
+        Predicted class probabilities of a fully-specified input (requires an artifact saved with probabilities).
+        Args:
+            record (dict): Level of every feature, keyed by feature name.
+
+        Returns:
+            Dict of probability by class label.
+        """
+        if self.pred_proba is None:
+            raise ValueError("Prediction lookup was saved without probabilities")
+        proba = self.pred_proba[self.combination_id(record)]
+        return dict(zip(self.classes, proba.tolist()))
+
+    def level_codes(self, data):
+        """
+        Category codes of many inputs at once.
+        Args:
+            data (dataframe): Level of each feature, one row per input, with a column per feature name.
+
+        Returns:
+            2d int array with a row per input and a column per feature - -1 where a feature is missing or a level was
+            not seen in training.
+        """
+        return level_codes(data, self.features, self.levels)
+
+    def combination_ids(self, data):
+        """
+        Combination ids of many fully-specified inputs at once.
+        Args:
+            data (dataframe): Level of each feature, one row per input, with a column per feature name.
+
+        Returns:
+            ids (1d int array): Combination id of each input (0 where the input is not valid).
+            valid (1d bool array): Whether every feature of the input was given with a level seen in training.
+        """
+        codes = self.level_codes(data)
+        valid = (codes >= 0).all(axis=1)
+        ids = np.ravel_multi_index(tuple(np.where(valid, codes.T, 0)), self.sizes)
+        return ids, valid
+
+    def predict_many(self, data):
+        """
+        Predicted classes of many fully-specified inputs, in one vectorized lookup.
+        Args:
+            data (dataframe): Level of each feature, one row per input, with a column per feature name.
+
+        Returns:
+            labels (1d object array): Predicted class label of each input, None where it is not valid.
+            valid (1d bool array): Whether every feature of the input was given with a level seen in training.
+        """
+        ids, valid = self.combination_ids(data)
+        labels = self.classes[np.asarray(self.pred_codes[ids])]
+        labels[~valid] = None
+        return labels, valid
+
+    def predict_proba_many(self, data):
+        """
+        Predicted class probabilities of many fully-specified inputs (requires an artifact saved with probabilities).
+        Args:
+            data (dataframe): Level of each feature, one row per input, with a column per feature name.
+
+        Returns:
+            2d float array with a row per input and a column per class - NaN where the input is not valid.
+        """
+        if self.pred_proba is None:
+            raise ValueError("Prediction lookup was saved without probabilities")
+        ids, valid = self.combination_ids(data)
+        proba = np.array(self.pred_proba[ids], dtype=float)
+        proba[~valid] = np.nan
+        return proba
@@ -0,0 +1,92 @@
+import collections
+import logging
+import sys
+import time
+
+logger = logging.getLogger('search_cache')
+
+def normalize_selection(form, fields):
+    """
+    Normalized, ordered key for a search.
+    Args:
+        form (mapping): Submitted search form.
+        fields (list): Names of the searchable fields, in a fixed order.
+
+    Returns:
+        Tuple of (field, value) pairs for the fields with a (whitespace-stripped) value, in `fields` order.
+    """
+    selection = []
+    for f in fields:
+        value = (form.get(f) or "").strip()
+        if value:
+            selection.append((f, value))
+    return tuple(selection)
+
+def result_size(value):
+    """Approximate memory used by a cached search result (lists, tuples and dicts of strings and numbers), in bytes."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(result_size(k) + result_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(result_size(item) for item in value)
+    return size
+
+class SearchCache:
+    """LRU cache of search results with a time-to-live, tied to the version of the data they were read from.
+
+    Entries expire after `ttl` seconds, the least recently used entry is evicted beyond `maxsize` entries, and the
+    whole cache is cleared when the data version changes (a database rebuild).
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+
+    def set_version(self, version):
+        """Clear the cache if the data version has changed."""
+        if version != self.version:
+            if self.entries:
+                logger.info("Data version changed from {} to {} - clearing search cache".format(self.version, version))
+            self.clear()
+            self.version = version
+
+    def get(self, key):
+        """Cached result for `key`, or None if it is not cached or has expired."""
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                self.pop(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        """Cache the result for `key`, evicting the least recently used entries beyond `maxsize`."""
+        if key in self.entries:
+            self.pop(key)
+        size = result_size(value)
+        self.entries[key] = (time.monotonic(), value, size)
+        self.nbytes += size
+        while len(self.entries) > self.maxsize:
+            self.pop(next(iter(self.entries)))
+
+    def pop(self, key):
+        self.nbytes -= self.entries.pop(key)[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Hit rate, size and approximate memory use of the cache."""
+        requests = self.hits + self.misses
+        return {"entries": len(self.entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0, "bytes": self.nbytes,
+                "version": self.version}
@@ -0,0 +1,98 @@
+import collections
+import logging
+import numpy as np
+import sqlalchemy as sql
+
+logger = logging.getLogger('search_planner')
+
+# statement prefix that asks each database for its query plan
+EXPLAIN_PREFIX = {"sqlite": "EXPLAIN QUERY PLAN", "mysql": "EXPLAIN", "postgresql": "EXPLAIN"}
+
+def table_indexes(engine, table_name):
+    """
+    Secondary indexes of a table, as built in the database.
+    Args:
+        engine (Engine): SQLAlchemy engine connected to the database.
+        table_name (str): Name of the table.
+
+    Returns:
+        dict of index name to the list of its columns, in index order.
+    """
+    return {ix["name"]: ix["column_names"] for ix in sql.inspect(engine).get_indexes(table_name)}
+
+def choose_index(fields, indexes, n_levels=None):
+    """
+    Choose the most selective index for an equality search on some fields.
+
+    An index can only be used for the run of its leading columns that are all searched on; among indexes with such a
+    prefix the one whose prefix has the most distinct value combinations (product of the columns' numbers of levels)
+    is the most selective.
+    Args:
+        fields (collection of str): Columns the search filters on.
+        indexes (dict): Index name to list of columns, as returned by `table_indexes`.
+        n_levels (dict, default None): Number of distinct values of each column - columns not given count as 2.
+
+    Returns:
+        Name of the chosen index, or None if no index starts with a searched column.
+    """
+    n_levels = n_levels or {}
+    best, best_selectivity = None, 1
+    for name, columns in indexes.items():
+        selectivity = 1
+        for col in columns:
+            if col not in fields:
+                break
+            selectivity *= n_levels.get(col, 2)
+        if selectivity > best_selectivity:
+            best, best_selectivity = name, selectivity
+    return best
+
+def apply_index_hint(query, model, index, dialect_name):
+    """
+    Direct a query to an index where the database accepts index hints (MySQL); other databases' planners choose
+    themselves.
+    Args:
+        query (Query): SQLAlchemy query on `model`.
+        model (declarative class): Data model the query selects from.
+        index (str): Name of the index, or None.
+        dialect_name (str): Name of the database dialect, e.g. "mysql".
+
+    Returns:
+        Query, with an index hint added if supported.
+    """
+    if index is not None and dialect_name == "mysql":
+        return query.with_hint(model, "USE INDEX ({})".format(index), "mysql")
+    return query
+
+def explain_query(session, query):
+    """
+    Query plan the database will use for a query.
+    Args:
+        session (Session): SQLAlchemy session bound to the database.
+        query (Query): Query to explain.
+
+    Returns:
+        List of the rows of the database's query plan, or None if the database is not supported.
+    """
+    connection = session.connection()
+    prefix = EXPLAIN_PREFIX.get(connection.dialect.name)
+    if prefix is None:
+        return None
+    statement = query.statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+    return [tuple(row) for row in connection.execute(sql.text("{} {}".format(prefix, statement))).fetchall()]
+
+class SearchStats:
+    """Recent search latencies and counts of the field combinations searched on."""
+
+    def __init__(self, window=1000):
+        self.latencies = collections.deque(maxlen=window)
+        self.field_usage = collections.Counter()
+
+    def record(self, fields, latency_ms):
+        """Record one search by the fields it used and its latency in milliseconds."""
+        self.field_usage[tuple(sorted(fields))] += 1
+        self.latencies.append(latency_ms)
+
+    def percentile(self, q):
+        """Latency percentile `q` (0-100) over the recent window, in milliseconds."""
+        return float(np.percentile(self.latencies, q)) if self.latencies else 0.0
@@ -0,0 +1,174 @@
+import datetime
+import hashlib
+import json
+import logging
+import math
+import time
+import fsspec
+from src.data_io import dataset_parts
+
+logger = logging.getLogger('stage_cache')
+
+def file_fingerprint(location):
+    """
+    Fingerprint of the content of a file or partitioned dataset.
+
+    Local files are hashed; for S3 objects the ETag (a hash computed by S3) and size are used so nothing is downloaded.
+    Args:
+        location (str): Filepath of the file or dataset (all parts listed in its manifest are included).
+
+    Returns:
+        String fingerprint, or None if the file does not exist.
+    """
+    fingerprints = []
+    for part in dataset_parts(location):
+        fs, path = fsspec.core.url_to_fs(part)
+        if not fs.exists(path):
+            return None
+        info = fs.info(path)
+        if info.get("ETag"):
+            fingerprints.append("{}:{}".format(info["ETag"].strip('"'), info["size"]))
+        else:
+            sha256 = hashlib.sha256()
+            with fs.open(path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    sha256.update(block)
+            fingerprints.append(sha256.hexdigest())
+    return ",".join(fingerprints)
+
+def code_fingerprint(code):
+    """
+    Fingerprint of the source files implementing a stage.
+    Args:
+        code (list of str): Filepaths of the stage's source files.
+
+    Returns:
+        Hex digest of the files' contents.
+    """
+    sha256 = hashlib.sha256()
+    for path in code:
+        with open(path, "rb") as f:
+            sha256.update(f.read())
+    return sha256.hexdigest()
+
+def outputs_exist(outputs):
+    """Whether every output file of a stage exists."""
+    for location in outputs:
+        fs, path = fsspec.core.url_to_fs(location)
+        if not fs.exists(path):
+            return False
+    return True
+
+def outputs_written(outputs, since):
+    """Whether every output file of a stage exists and was modified at or after `since` (seconds since the epoch)."""
+    for location in outputs:
+        fs, path = fsspec.core.url_to_fs(location)
+        if not fs.exists(path) or fs.modified(path).timestamp() < since:
+            return False
+    return True
+
+class StageCache:
+    """Record of the fingerprint (inputs, config and code) each pipeline stage last ran with, saved as a JSON manifest.
+
+    A stage whose fingerprint is unchanged and whose outputs exist is reused instead of run again. A stage is only
+    recorded once it has succeeded - the stage functions log errors rather than raise them, so success is judged by
+    every output having been written during the run. When the cache is not enabled, every stage runs and nothing is
+    recorded.
+    """
+
+    def __init__(self, location, enabled=True):
+        self.location = location
+        self.enabled = enabled
+        self.stages = {}
+        self.run = {}
+        self.unchanged = set()
+        if not enabled:
+            return
+        try:
+            with fsspec.open(location, "r") as f:
+                self.stages = json.load(f)["stages"]
+        except FileNotFoundError:
+            pass
+
+    def mark_unchanged(self, location):
+        """Record that an input is known to be unchanged since the last run (e.g. by a conditional download), so the
+        fingerprint recorded for it is reused rather than computed again."""
+        self.unchanged.add(location)
+
+    def input_fingerprint(self, location):
+        """Fingerprint of an input artifact - the recorded one if the input is marked unchanged."""
+        if location in self.unchanged:
+            for previous in self.stages.values():
+                if previous.get("inputs", {}).get(location):
+                    return previous["inputs"][location]
+        return file_fingerprint(location)
+
+    def fingerprint(self, inputs, config, keys, code):
+        """
+        Fingerprint of a stage.
+        Args:
+            inputs (list of str): Filepaths of the stage's input artifacts.
+            config (dict): Pipeline configuration.
+            keys (list of str): Configuration keys the stage depends on.
+            code (list of str): Filepaths of the stage's source files.
+
+        Returns:
+            dict of the input, config and code fingerprints and their combined `fingerprint`.
+        """
+        parts = {"inputs": {location: self.input_fingerprint(location) for location in inputs},
+                 "config": hashlib.sha256(json.dumps({key: config.get(key) for key in keys}, sort_keys=True,
+                                                     default=str).encode()).hexdigest(),
+                 "code": code_fingerprint(code)}
+        parts["fingerprint"] = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+        return parts
+
+    def run_stage(self, stage, func, inputs, config, keys, code, outputs, state=None):
+        """
+        Run a stage unless its fingerprint matches the last successful run and its outputs exist.
+        Args:
+            stage (str): Name of the stage.
+            func (callable): Function running the stage.
+            inputs (list of str): Filepaths of the stage's input artifacts.
+            config (dict): Pipeline configuration.
+            keys (list of str): Configuration keys the stage depends on.
+            code (list of str): Filepaths of the stage's source files.
+            outputs (list of str): Filepaths of the stage's output artifacts.
+            state (callable, default None): Returns the current state of an output not kept in files, e.g. the data
+                version of a database. The stage has succeeded only if this matches the value `func` returned, and is
+                reused only while it still matches the value recorded then.
+
+        Returns:
+            True if the stage ran, False if it was reused.
+        """
+        if not self.enabled:
+            func()
+            return True
+
+        fingerprint = self.fingerprint(inputs, config, keys, code)
+        previous = self.stages.get(stage, {})
+        if previous.get("fingerprint") == fingerprint["fingerprint"] and outputs_exist(outputs) and \
+                (state is None or previous.get("state") is not None and state() == previous["state"]):
+            logger.info("Stage {} unchanged since {} - reusing its outputs".format(stage, previous["time"]))
+            self.run[stage] = "reused"
+            self.save()
+            return False
+
+        # whole seconds, as S3 keeps modification times to the second
+        started = math.floor(time.time())
+        result = func()
+        if outputs_written(outputs, started) and (state is None or result is not None and state() == result):
+            self.stages[stage] = dict(fingerprint, outputs=outputs, time=datetime.datetime.now().isoformat())
+            if state is not None:
+                self.stages[stage]["state"] = result
+            self.run[stage] = "ran"
+        else:
+            logger.warning("Stage {} failed or did not write all of its outputs - not cached".format(stage))
+            self.stages.pop(stage, None)
+            self.run[stage] = "failed"
+        self.save()
+        return True
+
+    def save(self):
+        """Write the manifest, including which stages ran or were reused in this run."""
+        with fsspec.open(self.location, "w") as f:
+            json.dump({"stages": self.stages, "last_run": self.run}, f, indent=2)
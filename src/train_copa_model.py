@@ -1,16 +1,39 @@
+import json
+import numpy as np
 import pandas as pd
 import logging
+import os
 import s3fs
 import pickle
+import time
+import scipy.sparse
+import scipy.stats
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from sklearn import model_selection
-from sklearn.preprocessing import OneHotEncoder
-from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 - makes HalvingGridSearchCV importable
+from sklearn.model_selection import HalvingGridSearchCV
+from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder
+from sklearn.ensemble import GradientBoostingClassifier, HistGradientBoostingClassifier
+from sklearn.inspection import permutation_importance
+from src.data_io import TableWriter, part_location, read_table, write_manifest, write_table
+from src.prediction_lookup import save_lookup
+from src.tree_model import export_model
+from src.vocab import apply_vocab, one_hot_codes, read_vocab, vocab_dtypes
 
 logger = logging.getLogger('train_model')
 
+# estimator backends fit_model can train: "gradient_boosting" (one-hot encoded features) or "hist_gradient_boosting"
+# (ordinal-encoded features, split natively as categories)
+BACKENDS = ["gradient_boosting", "hist_gradient_boosting"]
+
 def train_copa_model(clean_loc, features, target, split_random_state, test_size,
-                     model_loc, fit_random_state,ov_acc_loc, acc_loc, prev_loc, var_loc, app_loc, app_flag):
+                     model_loc, fit_random_state,ov_acc_loc, acc_loc, prev_loc, var_loc, app_loc, app_flag,
+                     app_chunk_size=100000, lookup_loc=None, lookup_proba=False, sparse=False,
+                     app_workers=1, data_format=None, artifact_loc=None, backend="gradient_boosting", runs_loc=None,
+                     search_grid=None, search_cv=3, search_halving=True, search_jobs=-1, leaderboard_loc=None,
+                     vocab_loc=None, metrics_loc=None, eval_chunk_size=100000, importance_loc=None,
+                     importance_repeats=10, importance_workers=1):
     """
     Train model and save out artifacts and all combinations of input variables, which can be used to create database for app.
     Args:
@@ -28,41 +51,101 @@ def train_copa_model(clean_loc, features, target, split_random_state, test_size,
         var_loc (str): Filepath to save information about variable importance in the model.
         app_loc (str): Filepath to save all combinations of input features with their predicted responses.
         app_flag (Bool): Flag for whether to generate all unique combinations of input data, which can then be saved to database for use in app.
+        app_chunk_size (int, default 100000): Number of unique combinations to score and write at a time.
+        lookup_loc (str, default None): Filepath to save the prediction lookup (.npy) for all unique combinations.
+        lookup_proba (bool, default False): Whether to also save class probabilities in the prediction lookup.
+        sparse (bool, default False): Whether to keep one-hot encoded data in scipy CSR form for training, evaluation
+            and scoring of unique combinations.
+        app_workers (int, default 1): Number of processes to score unique combinations with - each writes its own part
+            file of the combination table.
+        data_format (str, default None): Format of the clean data and combination table ("csv", "parquet" or
+            "feather") - taken from the file extensions if None.
+        artifact_loc (str, default None): Directory to export the trained model to as NumPy arrays (see
+            `tree_model.export_model`) - not exported if None. Only gradient_boosting models can be exported.
+        backend (str, default "gradient_boosting"): Estimator to train, one of `BACKENDS`.
+        runs_loc (str, default None): Filepath of a CSV to append the backend, fit time and accuracy of this run to -
+            not recorded if None.
+        search_grid (dict, default None): Hyperparameter values to search over before fitting the model (see
+            `search_hyperparameters`) - the model is fit with the estimator's defaults if None.
+        search_cv (int, default 3): Number of cross-validation folds of the hyperparameter search.
+        search_halving (bool, default True): Whether the hyperparameter search uses successive halving.
+        search_jobs (int, default -1): Number of parallel jobs of the hyperparameter search (-1 for all cores).
+        leaderboard_loc (str, default None): Filepath to save the hyperparameter search's candidates and scores.
+        vocab_loc (str, default None): Filepath of the category vocabulary saved by cleaning - features are read and
+            encoded as category codes if given, as labels otherwise.
+        metrics_loc (str, default None): Filepath to save all evaluation metrics to (.json).
+        eval_chunk_size (int, default 100000): Number of test rows to score at a time when evaluating the model.
+        importance_loc (str, default None): Filepath to save the permutation importance of each feature (.csv) - not
+            computed if None.
+        importance_repeats (int, default 10): Number of times each feature is shuffled for its permutation importance.
+        importance_workers (int, default 1): Number of processes to compute permutation importance with.
 
     Returns:
         None.
     """
 
+    vocab = None
+    if vocab_loc is not None:
+        try:
+            vocab = read_vocab(vocab_loc)
+        except FileNotFoundError:
+            logger.warning("No vocabulary at {} - features are read as strings".format(vocab_loc))
     X_train, X_test, y_train, y_test = train_test_split(clean_loc, features, target,
-                                                        split_random_state, test_size)
-    X_train_enc, X_test_enc, xenc = encode_data(X_train, X_test)
+                                                        split_random_state, test_size, data_format, vocab)
+    X_train_enc, X_test_enc, xenc = encode_data(X_train, X_test, sparse, backend)
+
+    params = None
+    if search_grid is not None:
+        params = search_hyperparameters(X_train_enc, y_train, fit_random_state, search_grid, backend, search_cv,
+                                        search_halving, search_jobs, leaderboard_loc)
 
-    gb_model = fit_model(X_train_enc, y_train, fit_random_state)
+    fit_start = time.perf_counter()
+    gb_model = fit_model(X_train_enc, y_train, fit_random_state, backend, params)
+    fit_seconds = time.perf_counter() - fit_start
 
     with open(model_loc, "wb") as f:
         pickle.dump(gb_model,f)
         f.close()
+    if artifact_loc is not None and backend == "gradient_boosting":
+        export_model(gb_model, xenc, artifact_loc)
+    elif artifact_loc is not None:
+        logger.warning("Model not exported to {} - only gradient_boosting models can be exported".format(artifact_loc))
 
-    model_accuracy(X_test_enc, y_test, gb_model, xenc, features, ov_acc_loc, acc_loc, prev_loc, var_loc)
+    overall_acc = model_accuracy(X_test_enc, y_test, gb_model, xenc, features, ov_acc_loc, acc_loc, prev_loc, var_loc,
+                                 metrics_loc, eval_chunk_size)
+    if importance_loc is not None:
+        permutation_importance_by_feature(gb_model, X_test_enc, y_test, xenc, features, importance_loc,
+                                          importance_repeats, importance_workers, fit_random_state)
+    if runs_loc is not None:
+        record_run(runs_loc, backend, target, len(X_train), fit_seconds, overall_acc)
     if app_flag:
-        unique_data_combinations(X_train, gb_model, xenc, app_loc)
+        unique_data_combinations(X_train, gb_model, xenc, app_loc, app_chunk_size, lookup_loc, lookup_proba,
+                                 app_workers, data_format)
 
 
-def train_test_split(clean_loc, features, target, random_state, test_size):
+def train_test_split(clean_loc, features, target, random_state, test_size, data_format=None, vocab=None):
     """
     Split data into train and test sets.
     Args:
-        clean_loc(str): Filepath to data.
+        clean_loc(str): Filepath to data - only the feature and target columns are read.
         features (list of strings): List of columns to include as features for training.
         target (str): Name of target (response) column.
         random_state (int): Random state seed for train/test.
         test_size (float): Proportion of data to hold out as test set.
+        data_format (str, default None): Format of the data ("csv", "parquet" or "feather") - taken from the file
+            extension if None.
+        vocab (dict, default None): Category vocabulary saved by cleaning - features are read as categoricals with
+            its categories (int8 codes rather than strings) if given.
 
     Returns:
         X_train, X_test, y_train, y_test dataframes/arrays of split data - X dataframes are features, y are response variables.
     """
     try:
-        data = pd.read_csv(clean_loc)
+        feature_vocab = {col: vocab[col] for col in features} if vocab is not None else None
+        data = read_table(clean_loc, columns=list(features) + [target], fmt=data_format,
+                          dtype=vocab_dtypes(feature_vocab) if feature_vocab else None)
+        if feature_vocab:
+            data = apply_vocab(data, feature_vocab)
         X_train, X_test, y_train, y_test = model_selection.train_test_split(data[features],
                                                                             data[target], random_state=random_state,
                                                                             test_size=test_size)
@@ -71,53 +154,208 @@ def train_test_split(clean_loc, features, target, random_state, test_size):
     except Exception as e:
         logger.error(e)
 
-def encode_data(X_train, X_test):
+def encode_data(X_train, X_test, sparse=False, backend="gradient_boosting"):
     """
-    One-hot encode features.
+    One-hot encode features, or ordinal encode them for the hist_gradient_boosting backend.
     Args:
         X_train (dataframe): Train dataframe (all categorical features).
         X_test (dataframe): Test dataframe (all categorical features).
+        sparse (bool, default False): Whether to keep the encoded data as scipy CSR matrices instead of dataframes.
+            Ignored for ordinal encoding, which has one dense column per feature.
+        backend (str, default "gradient_boosting"): Estimator the data is encoded for, one of `BACKENDS`.
 
     Returns:
-        X_train, X_test, xenc - dataframes are now one-hot encoded, xenc is the encoder object.
+        X_train, X_test, xenc - dataframes (or CSR matrices if `sparse`) are now one-hot (or ordinal) encoded, xenc is
+        the encoder object.
     """
     try:
+        if all(isinstance(dtype, pd.CategoricalDtype) for dtype in X_train.dtypes):
+            return encode_categorical(X_train, X_test, sparse, backend)
+        if backend == "hist_gradient_boosting":
+            # category codes as floats - levels not seen in training become -1, which the model treats as missing
+            xenc = OrdinalEncoder(handle_unknown='use_encoded_value', unknown_value=-1)
+            xenc.fit(X_train)
+            X_train_enc = pd.DataFrame(xenc.transform(X_train))
+            X_test_enc = pd.DataFrame(xenc.transform(X_test))
+            logger.info("Data ordinal encoded")
+            return X_train_enc, X_test_enc, xenc
         #encode feature variables
-        xenc = OneHotEncoder(sparse=False, handle_unknown='ignore')
+        xenc = OneHotEncoder(sparse=sparse, handle_unknown='ignore')
         xenc.fit(X_train)
-        X_train_enc = pd.DataFrame(xenc.transform(X_train))
-        X_test_enc = pd.DataFrame(xenc.transform(X_test))
-        logger.info("Data encoded")
+        if sparse:
+            X_train_enc = xenc.transform(X_train).tocsr()
+            X_test_enc = xenc.transform(X_test).tocsr()
+            dense_bytes = (X_train_enc.shape[0] + X_test_enc.shape[0]) * X_train_enc.shape[1] * X_train_enc.dtype.itemsize
+            sparse_bytes = sparse_nbytes(X_train_enc) + sparse_nbytes(X_test_enc)
+            logger.info("Data encoded as sparse matrices - {:.1f} MB instead of {:.1f} MB dense ({:.1f} MB saved)".format(
+                sparse_bytes / 1e6, dense_bytes / 1e6, (dense_bytes - sparse_bytes) / 1e6))
+        else:
+            X_train_enc = pd.DataFrame(xenc.transform(X_train))
+            X_test_enc = pd.DataFrame(xenc.transform(X_test))
+            logger.info("Data encoded")
         return X_train_enc, X_test_enc, xenc
     except Exception as e:
         logger.error(e)
 
+def encode_categorical(X_train, X_test, sparse=False, backend="gradient_boosting"):
+    """
+    Helper function for encode_data - encode categorical features from their codes, without matching any labels.
+
+    The encoder is fitted with the categories seen in the training data, as if fitted on the labels, so that it can
+    be used to encode labels later (and for its categories and feature names).
+    Args:
+        X_train (dataframe): Train dataframe of categorical columns.
+        X_test (dataframe): Test dataframe of categorical columns with the same categories.
+        sparse (bool, default False): Whether to keep one-hot encoded data as scipy CSR matrices.
+        backend (str, default "gradient_boosting"): Estimator the data is encoded for, one of `BACKENDS`.
+
+    Returns:
+        X_train, X_test, xenc - as for encode_data.
+    """
+    levels = [X_train[col].cat.remove_unused_categories().cat.categories for col in X_train.columns]
+    train_codes = np.column_stack([X_train[col].cat.set_categories(lev).cat.codes
+                                   for col, lev in zip(X_train.columns, levels)])
+    test_codes = np.column_stack([X_test[col].cat.set_categories(lev).cat.codes
+                                  for col, lev in zip(X_train.columns, levels)])
+    first_levels = pd.DataFrame({col: lev[:1] for col, lev in zip(X_train.columns, levels)})
+    if backend == "hist_gradient_boosting":
+        xenc = OrdinalEncoder(categories=[list(lev) for lev in levels], handle_unknown='use_encoded_value',
+                              unknown_value=-1).fit(first_levels)
+    else:
+        xenc = OneHotEncoder(categories=[list(lev) for lev in levels], sparse=sparse,
+                             handle_unknown='ignore').fit(first_levels)
+    X_train_enc = encode_codes(train_codes, levels, xenc)
+    X_test_enc = encode_codes(test_codes, levels, xenc)
+    if not scipy.sparse.issparse(X_train_enc):
+        X_train_enc, X_test_enc = pd.DataFrame(X_train_enc), pd.DataFrame(X_test_enc)
+    logger.info("Data encoded from {} category codes".format(train_codes.dtype))
+    return X_train_enc, X_test_enc, xenc
+
+def encode_codes(codes, levels, enc):
+    """
+    Encode category codes as `enc` would encode their labels.
+    Args:
+        codes (2d int array): Category codes, one column per feature (-1 for missing or unknown levels).
+        levels (list of arrays): Category levels of each feature, as in `enc.categories_`.
+        enc (Encoder): OneHotEncoder or OrdinalEncoder with the categories `levels`.
+
+    Returns:
+        Array (or CSR matrix for a sparse OneHotEncoder) as returned by `enc.transform`.
+    """
+    if isinstance(enc, OrdinalEncoder):
+        return codes.astype(np.float64)
+    one_hot = one_hot_codes(codes, [len(lev) for lev in levels])
+    return one_hot if enc.sparse else one_hot.toarray()
+
+def sparse_nbytes(X_enc):
+    """Helper function for encode_data - memory used by a CSR matrix's data and index arrays."""
+    return X_enc.data.nbytes + X_enc.indices.nbytes + X_enc.indptr.nbytes
+
 
-def fit_model(X_train_enc, y_train, random_state):
+def fit_model(X_train_enc, y_train, random_state, backend="gradient_boosting", params=None):
     """
-    Fit a GradientBoostingClassifier model.
+    Fit a GradientBoostingClassifier or HistGradientBoostingClassifier model.
     Args:
-        X_train (dataframe): Input data (features only).
+        X_train (dataframe or CSR matrix): Input data (features only) - ordinal encoded for hist_gradient_boosting.
         y_train (1d array): Target variable.
         random_state (int): Random state for model fitting.
+        backend (str, default "gradient_boosting"): Estimator to fit, one of `BACKENDS`.
+        params (dict, default None): Hyperparameters of the estimator, e.g. from `search_hyperparameters` - the
+            estimator's defaults if None.
 
     Returns:
         Trained model object.
     """
     try:
         # fit model
-        gb = GradientBoostingClassifier(random_state=random_state)
+        gb = build_estimator(backend, random_state, X_train_enc.shape[1], params)
         gb_model = gb.fit(X_train_enc, y_train)
-        logger.info("Model fit")
+        logger.info("Model fit ({})".format(backend))
         return gb_model
     except Exception as e:
         logger.error(e)
 
-def model_accuracy(X_test_enc, y_test, model, enc, features, ov_acc_loc, acc_loc, prev_loc, var_loc):
+def build_estimator(backend, random_state, n_columns, params=None):
+    """Helper function for fit_model and search_hyperparameters - unfitted estimator of a backend."""
+    if backend == "gradient_boosting":
+        gb = GradientBoostingClassifier(random_state=random_state)
+    elif backend == "hist_gradient_boosting":
+        # every column is a categorical feature, split on sets of categories rather than thresholds
+        gb = HistGradientBoostingClassifier(categorical_features=np.ones(n_columns, dtype=bool),
+                                            random_state=random_state)
+    else:
+        raise ValueError("Unknown model backend {} - expected one of {}".format(backend, BACKENDS))
+    return gb.set_params(**(params or {}))
+
+def search_hyperparameters(X_train_enc, y_train, random_state, grid, backend="gradient_boosting", cv=3, halving=True,
+                           n_jobs=-1, leaderboard_loc=None):
+    """
+    Cross-validated search for the best hyperparameters of a backend's estimator.
+
+    The data is encoded once, before the search, and every candidate is fit on folds of the same encoded data. With
+    `halving`, candidates are first scored on a small sample of the training rows and only the best third go on to
+    the next round with three times as many rows (successive halving), so weak candidates are dropped early.
+    Args:
+        X_train_enc (dataframe or CSR matrix): Encoded input data (features only), as for fit_model.
+        y_train (1d array): Target variable.
+        random_state (int): Random state for model fitting and for the folds.
+        grid (dict): Values to try for each hyperparameter of the estimator, keyed by parameter name.
+        backend (str, default "gradient_boosting"): Estimator to tune, one of `BACKENDS`.
+        cv (int, default 3): Number of stratified cross-validation folds.
+        halving (bool, default True): Whether to use successive halving rather than scoring every candidate on all
+            rows.
+        n_jobs (int, default -1): Number of candidates/folds to fit in parallel (-1 for all cores).
+        leaderboard_loc (str, default None): Filepath to save every candidate's parameters and scores (.csv), best
+            first - not saved if None.
+
+    Returns:
+        dict of the best hyperparameters.
+    """
+    try:
+        estimator = build_estimator(backend, random_state, X_train_enc.shape[1])
+        folds = model_selection.StratifiedKFold(n_splits=cv, shuffle=True, random_state=random_state)
+        if halving:
+            search = HalvingGridSearchCV(estimator, grid, cv=folds, factor=3, refit=False, n_jobs=n_jobs,
+                                         random_state=random_state)
+        else:
+            search = model_selection.GridSearchCV(estimator, grid, cv=folds, refit=False, n_jobs=n_jobs)
+        search.fit(X_train_enc, y_train)
+        logger.info("Hyperparameter search ({} candidates): best {} with accuracy {:.4f}".format(
+            len(search.cv_results_["params"]), search.best_params_, search.best_score_))
+        if leaderboard_loc is not None:
+            leaderboard(search.cv_results_).to_csv(leaderboard_loc, index=False)
+            logger.info("Hyperparameter leaderboard saved to {}".format(leaderboard_loc))
+        return search.best_params_
+    except Exception as e:
+        logger.error(e)
+
+def leaderboard(cv_results):
+    """
+    Helper function for search_hyperparameters - candidates of a search with their scores, best first.
+
+    With successive halving, candidates that reached a later round (scored on more rows) rank above those dropped
+    earlier.
+    """
+    results = pd.DataFrame(cv_results)
+    board = pd.DataFrame({"params": [json.dumps(p, sort_keys=True) for p in results["params"]],
+                          "mean_accuracy": results["mean_test_score"],
+                          "std_accuracy": results["std_test_score"],
+                          "mean_fit_seconds": results["mean_fit_time"],
+                          "round": results.get("iter", 0),
+                          "n_rows": results.get("n_resources", np.nan)})
+    board = board.sort_values(["round", "mean_accuracy"], ascending=False, ignore_index=True)
+    board.insert(0, "rank", np.arange(1, len(board) + 1))
+    return board
+
+def model_accuracy(X_test_enc, y_test, model, enc, features, ov_acc_loc, acc_loc, prev_loc, var_loc, metrics_loc=None,
+                   chunk_size=100000):
     """
     Calculate accuracy on test set and accuracy by category on test set.
+
+    All metrics come from one confusion matrix (and the summed log-loss), accumulated over chunks of the test set by
+    `evaluate_model`.
     Args:
-        X_test_enc (dataframe or array): One-hot encoded data for the feature test set.
+        X_test_enc (dataframe, array or CSR matrix): Encoded data for the feature test set.
         y_test (series, dataframe, or 1d array): Response variable values for test set. Should not be encoded.
         model (trained model object): Previously trained model.
         enc (Encoder): Sklearn encoder trained on the training data.
@@ -126,82 +364,452 @@ def model_accuracy(X_test_enc, y_test, model, enc, features, ov_acc_loc, acc_loc
         acc_loc (str): Filepath to save information about model accuracy by class.
         prev_loc (str): Filepath to save information about class prevalence.
         var_loc (str): Filepath to save information about variable importance in the model.
+        metrics_loc (str, default None): Filepath to save all metrics to (.json) - not saved if None.
+        chunk_size (int, default 100000): Number of test rows to score at a time.
 
     Returns:
-        None.
+        Overall accuracy (float).
     """
     try:
-        #make a DF with outcomes and whether they were correct
-        pred_y_test = model.predict(X_test_enc)
-        acc = pd.DataFrame({"True": y_test, "Predicted": pred_y_test})
-        acc["Correct"] = acc["True"] == acc["Predicted"]
-        overall_acc = len(acc[acc["Correct"] == True]) / len(acc)
+        metrics = evaluate_model(model, held_out_chunks(X_test_enc, y_test, chunk_size))
+        overall_acc = metrics["accuracy"]
         with open(ov_acc_loc, "w") as f:
             f.write("Accuracy:" + str(overall_acc))
             f.close
         logger.info("Overall accuracy saved to {}".format(ov_acc_loc))
 
         # get prevalence of each category
-        group_prevalence = acc.groupby(["True"], as_index=False).count()
-        total = sum(group_prevalence["Correct"])
-        group_prevalence["Percent of total"] = group_prevalence["Correct"] / total
+        per_class = pd.DataFrame(metrics["classes"]).T
+        per_class = per_class[per_class["support"] > 0].sort_index()
+        support = per_class["support"].astype(int).values
+        group_prevalence = pd.DataFrame({"True": per_class.index, "Predicted": support, "Correct": support,
+                                         "Percent of total": per_class["prevalence"].values})
         group_prevalence.to_csv(prev_loc)
         logger.info("Group prevalence saved to {}".format(prev_loc))
 
-        # get accuracy by category
-        # get percent by group: https://stackoverflow.com/questions/23377108/pandas-percentage-of-total-with-groupby
-        acc = acc.groupby(["True", "Correct"]).count().groupby("True").apply(lambda x: 100 * x / float(x.sum()))
+        # get accuracy by category - percent of each true class predicted wrongly/correctly
+        recall = per_class["recall"].values.astype(float)
+        acc = pd.DataFrame({"True": np.repeat(per_class.index, 2), "Correct": np.tile([False, True], len(per_class)),
+                            "Predicted": np.column_stack([100 * (1 - recall), 100 * recall]).ravel()})
+        acc = acc[acc["Predicted"] > 0].set_index(["True", "Correct"])
         acc.to_csv(acc_loc)
         logger.info("Accuracy by group saved to {}".format(acc_loc))
 
+        if metrics_loc is not None:
+            with open(metrics_loc, "w") as f:
+                json.dump(metrics, f, indent=2)
+            logger.info("Metrics saved to {}".format(metrics_loc))
+
         # variable importance: https://stackoverflow.com/questions/39043326/computing-feature-importance-with-onehotencoded-features
-        variable_importances = pd.DataFrame(model.feature_importances_, index = enc.get_feature_names(features)).sort_values(by = 0, ascending = False)
+        if hasattr(model, "feature_importances_"):
+            variable_importances = pd.DataFrame(model.feature_importances_, index = enc.get_feature_names(features)).sort_values(by = 0, ascending = False)
+        else:
+            # no impurity-based importances (hist_gradient_boosting) - use the drop in test accuracy when each
+            # (ordinal-encoded) feature is shuffled
+            importances = permutation_importance(model, X_test_enc, y_test, n_repeats=5, random_state=0)
+            variable_importances = pd.DataFrame(importances.importances_mean, index = features).sort_values(by = 0, ascending = False)
         variable_importances.to_csv(var_loc)
         logger.info("Variable importance saved to {}".format(var_loc))
+        return overall_acc
     except Exception as e:
         logger.error("Problem in model accuracy evaluation")
         logger.error(e)
 
-def unique_data_combinations(X_train, model, enc, app_loc):
+def held_out_chunks(X_test_enc, y_test, chunk_size):
+    """Helper function for model_accuracy - split the encoded test set and its labels into chunks of rows."""
+    y_test = np.asarray(y_test)
+    for start in range(0, len(y_test), chunk_size):
+        X_chunk = X_test_enc[start:start + chunk_size] if scipy.sparse.issparse(X_test_enc) \
+            else X_test_enc.iloc[start:start + chunk_size] if isinstance(X_test_enc, pd.DataFrame) \
+            else X_test_enc[start:start + chunk_size]
+        yield X_chunk, y_test[start:start + chunk_size]
+
+def evaluate_model(model, chunks, eps=1e-15):
     """
-    Create a table of all possible data combinations and their associated predicted probabilities.
+    Evaluation metrics of a model on a held-out set, read one chunk at a time.
+
+    Each chunk is scored once (class probabilities - the predicted class is the most probable one) and only the
+    confusion matrix and the summed log-loss are kept, so the held-out set can be any size. Every metric is then
+    worked out from these with NumPy.
+    Args:
+        model (trained model object): Previously trained model.
+        chunks (iterable): (encoded features, true labels) of each chunk of the held-out set.
+        eps (float, default 1e-15): Probabilities are clipped to [eps, 1 - eps] for the log-loss.
+
+    Returns:
+        dict with the number of rows, overall accuracy, log-loss (None if some true labels are not classes of the
+        model), per-class support, prevalence, precision, recall and F1 keyed by class, and the confusion matrix
+        (rows true class, columns predicted class, in the order of `labels`).
+    """
+    labels = [str(c) for c in model.classes_]
+    n = len(labels)
+    confusion = np.zeros((n, n), dtype=np.int64)
+    extra = {}
+    log_loss_sum = 0.0
+    for X_chunk, y_chunk in chunks:
+        proba = model.predict_proba(X_chunk)
+        pred = np.argmax(proba, axis=1)
+        true = pd.Categorical(np.asarray(y_chunk).astype(str), categories=labels).codes.astype(np.int64)
+        known = true >= 0
+        confusion += np.bincount(true[known] * n + pred[known], minlength=n * n).reshape(n, n)
+        log_loss_sum -= np.log(np.clip(proba[known, true[known]], eps, 1 - eps)).sum()
+        # true labels the model never predicts still count as wrong predictions
+        for label in np.asarray(y_chunk).astype(str)[~known]:
+            extra[label] = extra.get(label, 0) + 1
+
+    support = confusion.sum(axis=1)
+    predicted = confusion.sum(axis=0)
+    correct = np.diag(confusion)
+    total = int(support.sum()) + sum(extra.values())
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(predicted > 0, correct / predicted, 0.0)
+        recall = np.where(support > 0, correct / support, 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    classes = {label: {"support": int(support[i]), "prevalence": float(support[i] / total),
+                       "precision": float(precision[i]), "recall": float(recall[i]), "f1": float(f1[i])}
+               for i, label in enumerate(labels)}
+    for label, count in extra.items():
+        classes[label] = {"support": count, "prevalence": count / total, "precision": 0.0, "recall": 0.0, "f1": 0.0}
+    metrics = {"n": total,
+               "accuracy": float(correct.sum() / total),
+               "log_loss": float(log_loss_sum / total) if not extra else None,
+               "classes": classes,
+               "labels": labels,
+               "confusion_matrix": confusion.tolist()}
+    logger.info("Evaluated on {} rows - accuracy {:.4f}".format(total, metrics["accuracy"]))
+    return metrics
+
+def permutation_importance_by_feature(model, X_test_enc, y_test, enc, features, importance_loc, n_repeats=10,
+                                      workers=1, random_state=0):
+    """
+    Permutation importance of each original feature - the drop in test accuracy when the feature's category codes are
+    shuffled across the test rows, which moves all of its one-hot columns together.
+
+    The category codes are recovered once from the encoded test set and shared with the workers; every (feature,
+    repeat) pair re-encodes the codes with one feature shuffled and scores them, in a process pool if `workers` > 1.
+    Each pair has its own random seed, so the results don't depend on the number of workers.
+    Args:
+        model (trained model object): Previously trained model.
+        X_test_enc (dataframe, array or CSR matrix): Encoded data for the feature test set.
+        y_test (series or 1d array): Response variable values for test set.
+        enc (Encoder): OneHotEncoder or OrdinalEncoder the model was trained with.
+        features (list): Feature names, in column order.
+        importance_loc (str): Filepath to save the importances (.csv).
+        n_repeats (int, default 10): Number of times each feature is shuffled.
+        workers (int, default 1): Number of worker processes.
+        random_state (int, default 0): Seed of the shuffles.
+
+    Returns:
+        Dataframe with the mean, standard deviation and 95% confidence interval of each feature's importance, most
+        important first.
+    """
+    try:
+        levels = [np.asarray(cats, dtype=object) for cats in enc.categories_]
+        codes = decode_codes(X_test_enc, levels, enc)
+        payload = pickle.dumps((model, enc, levels, codes, np.asarray(y_test)))
+        seeds = np.random.SeedSequence(random_state).spawn(len(features) * n_repeats)
+        tasks = [(j, seeds[j * n_repeats + r]) for j in range(len(features)) for r in range(n_repeats)]
+        if workers > 1:
+            logger.info("Permuting {} features {} times with {} worker processes".format(len(features), n_repeats,
+                                                                                         workers))
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_importance_worker,
+                                     initargs=(payload,)) as executor:
+                baseline = executor.submit(permuted_accuracy, None, None).result()
+                scores = list(executor.map(permuted_accuracy, *zip(*tasks)))
+        else:
+            init_importance_worker(payload)
+            baseline = permuted_accuracy(None, None)
+            scores = [permuted_accuracy(j, seed) for j, seed in tasks]
+
+        drops = baseline - np.asarray(scores).reshape(len(features), n_repeats)
+        mean = drops.mean(axis=1)
+        std = drops.std(axis=1, ddof=1) if n_repeats > 1 else np.zeros(len(features))
+        half_width = scipy.stats.t.ppf(0.975, max(n_repeats - 1, 1)) * std / np.sqrt(n_repeats)
+        importances = pd.DataFrame({"feature": features, "importance_mean": mean, "importance_std": std,
+                                    "ci_lower": mean - half_width, "ci_upper": mean + half_width,
+                                    "n_repeats": n_repeats})
+        importances = importances.sort_values("importance_mean", ascending=False, ignore_index=True)
+        importances.to_csv(importance_loc, index=False)
+        logger.info("Permutation importance by feature saved to {}".format(importance_loc))
+        return importances
+    except Exception as e:
+        logger.error(e)
+
+def decode_codes(X_enc, levels, enc):
+    """
+    Helper function for permutation_importance_by_feature - category codes of encoded data (the inverse of
+    `encode_codes`).
+
+    Returns:
+        2d int array with a column per feature - -1 where no level of the feature is set (unknown levels).
+    """
+    if isinstance(enc, OrdinalEncoder):
+        return np.nan_to_num(np.asarray(X_enc, dtype=np.float64), nan=-1).astype(np.int64)
+    X_enc = scipy.sparse.csr_matrix(X_enc)
+    offsets = np.concatenate([[0], np.cumsum([len(lev) for lev in levels])])
+    codes = np.empty((X_enc.shape[0], len(levels)), dtype=np.int64)
+    for j in range(len(levels)):
+        block = X_enc[:, offsets[j]:offsets[j + 1]]
+        codes[:, j] = np.where(block.getnnz(axis=1) > 0, np.asarray(block.argmax(axis=1)).ravel(), -1)
+    return codes
+
+# model, encoder, test codes and labels of a permutation importance worker process, set once by init_importance_worker
+_importance_worker = {}
+
+def init_importance_worker(payload):
+    """Helper function for permutation_importance_by_feature - unpickle the shared test set once per worker."""
+    _importance_worker["model"], _importance_worker["enc"], _importance_worker["levels"], \
+        _importance_worker["codes"], _importance_worker["y"] = pickle.loads(payload)
+
+def permuted_accuracy(feature, seed):
+    """
+    Helper function for permutation_importance_by_feature - test accuracy with the codes of column `feature`
+    shuffled (unshuffled if None).
+    """
+    model, enc, levels, codes, y = (_importance_worker[k] for k in ("model", "enc", "levels", "codes", "y"))
+    if feature is not None:
+        codes = codes.copy()
+        codes[:, feature] = np.random.default_rng(seed).permutation(codes[:, feature])
+    return float(np.mean(model.predict(encode_codes(codes, levels, enc)) == y))
+
+def record_run(runs_loc, backend, target, n_train, fit_seconds, accuracy):
+    """
+    Append the fit time and accuracy of a training run to a CSV, so that backends can be compared on the same data.
+    Args:
+        runs_loc (str): Filepath of the runs CSV - created with a header if it doesn't exist.
+        backend (str): Estimator backend of the run.
+        target (str): Name of target (response) column.
+        n_train (int): Number of training rows.
+        fit_seconds (float): Time taken to fit the model.
+        accuracy (float): Overall test accuracy.
+
+    Returns:
+        None.
+    """
+    try:
+        run = pd.DataFrame({"time": [pd.Timestamp.now().isoformat(timespec="seconds")], "backend": [backend],
+                            "target": [target], "n_train": [n_train], "fit_seconds": [round(fit_seconds, 3)],
+                            "accuracy": [accuracy]})
+        run.to_csv(runs_loc, mode="a", header=not os.path.exists(runs_loc), index=False)
+        logger.info("{} fit in {:.1f}s with accuracy {} - run recorded in {}".format(backend, fit_seconds, accuracy,
+                                                                                     runs_loc))
+    except Exception as e:
+        logger.error(e)
+
+def unique_data_combinations(X_train, model, enc, app_loc, chunk_size=100000, lookup_loc=None, save_proba=False,
+                             workers=1, data_format=None):
+    """
+    Score all possible data combinations into a prediction lookup and write the table of combinations with their
+    associated predicted classes.
+
+    Combinations are generated lazily in chunks of `chunk_size` rows from integer category codes, so each chunk is
+    encoded and scored before the next one is built. The predicted class codes are kept in a single array indexed by
+    combination id (the prediction lookup). With one worker the table is written from that array to `app_loc`; with
+    several workers each chunk is scored in a process pool and written by its worker to its own part file. Either way a
+    manifest listing the files of the table is written next to `app_loc`.
     Args:
         X_train (dataframe): Dataset from which unique combinations are to be taken.
         model (trained mode object): Trained model object to predict classes.
-        enc (Encoder): OneHotEncoder trained on training dataset.
+        enc (Encoder): OneHotEncoder (or OrdinalEncoder) trained on training dataset (combinations are scored sparse if
+            it is sparse).
         app_loc (str): Filepath to save all combinations of input features with their predicted responses.
+        chunk_size (int, default 100000): Number of combinations to score and write at a time.
+        lookup_loc (str, default None): Filepath to save the prediction lookup (.npy) - not saved if None.
+        save_proba (bool, default False): Whether to also score and save class probabilities in the prediction lookup.
+        workers (int, default 1): Number of processes to score combinations with.
+        data_format (str, default None): Format to write the combination table in ("csv", "parquet" or "feather") -
+            taken from the extension of `app_loc` if None.
 
     Returns:
         None.
     """
     try:
-        # generated a dataframe with all combinations of predictors
-        # approach from: https://stackoverflow.com/questions/53699012/performant-cartesian-product-cross-join-with-pandas
-        unique_data = pd.DataFrame()
-        for col in X_train.columns:
-            col_df = pd.DataFrame({col: X_train[col].unique()})
-            col_df['key'] = 1
-            logger.debug("Processing {}".format(col))
-            if len(unique_data) == 0:
-                unique_data = unique_data.append(col_df)
-            else:
-                unique_data = unique_data.merge(col_df, on="key")
-        unique_data.drop(columns = "key", inplace = True)
-        logger.info("Unique features dataset created")
-        # encode the data
-        logger.debug("Encoding unique data")
-        unique_data_enc = enc.transform(unique_data)
-        logger.debug("Generating predictions")
-        # generate predictions
-        unique_data["pred"] = model.predict(unique_data_enc)
+        columns = list(X_train.columns)
+        levels = [np.asarray(cats, dtype=object) for cats in enc.categories_]
+        if workers > 1:
+            pred_codes, pred_proba = score_combinations_parallel(columns, levels, model, enc, chunk_size, app_loc,
+                                                                 workers, save_proba, data_format)
+        else:
+            pred_codes, pred_proba = score_combinations(columns, levels, model, enc, chunk_size, save_proba)
         logger.info("Predictions generated")
-        logger.warning("Writing unique-combination data to file - this step takes several minutes to complete")
-        # save data
-        unique_data.to_csv(app_loc, index=False)
+        if lookup_loc is not None:
+            save_lookup(lookup_loc, columns, levels, model.classes_, pred_codes, pred_proba)
+        if workers <= 1:
+            logger.warning("Writing unique-combination data to file - this step takes several minutes to complete")
+            write_app_data(app_loc, columns, levels, model.classes_, pred_codes, chunk_size, data_format)
+            write_manifest(app_loc, [app_loc], [len(pred_codes)])
         logger.info('Data written to file in {}'.format(app_loc))
     except Exception as e:
         logger.error(e)
 
+def score_combinations(columns, levels, model, enc, chunk_size, save_proba=False):
+    """
+    Helper function for unique_data_combinations - predict the class of every combination of feature levels.
+    Args:
+        columns (list): Feature names, in column order.
+        levels (list of arrays): Category levels of each feature, in column order.
+        model (trained mode object): Trained model object to predict classes.
+        enc (Encoder): OneHotEncoder trained on training dataset.
+        chunk_size (int): Number of combinations to score at a time.
+        save_proba (bool, default False): Whether to also return class probabilities.
+
+    Returns:
+        pred_codes, pred_proba - index of the predicted class in `model.classes_` for each combination id, and the
+        class probabilities (None unless `save_proba`).
+    """
+    pred_codes, pred_proba = empty_predictions(levels, model, chunk_size, save_proba)
+    for start in range(0, len(pred_codes), chunk_size):
+        stop = min(start + chunk_size, len(pred_codes))
+        codes = combination_range(levels, start, stop)
+        pred_codes[start:stop], proba = score_codes(codes, columns, levels, model, enc, save_proba)
+        if save_proba:
+            pred_proba[start:stop] = proba
+        logger.debug("Scored combinations {}-{}".format(start, stop - 1))
+    return pred_codes, pred_proba
+
+def score_combinations_parallel(columns, levels, model, enc, chunk_size, app_loc, workers, save_proba=False,
+                                data_format=None):
+    """
+    Helper function for unique_data_combinations - score combination chunks in a process pool, each chunk written to
+    its own part file of `app_loc` by the worker that scored it.
+
+    The model and encoder are pickled once and unpickled once per worker, not per chunk.
+    Args:
+        columns (list): Feature names, in column order.
+        levels (list of arrays): Category levels of each feature, in column order.
+        model (trained mode object): Trained model object to predict classes.
+        enc (Encoder): OneHotEncoder trained on training dataset.
+        chunk_size (int): Number of combinations per chunk (and part file).
+        app_loc (str): Filepath of the combination table - part files and manifest are saved next to it.
+        workers (int): Number of worker processes.
+        save_proba (bool, default False): Whether to also return class probabilities.
+        data_format (str, default None): Format to write the part files in - taken from the extension of `app_loc` if None.
+
+    Returns:
+        pred_codes, pred_proba - as for score_combinations.
+    """
+    pred_codes, pred_proba = empty_predictions(levels, model, chunk_size, save_proba)
+    ranges = [(start, min(start + chunk_size, len(pred_codes))) for start in range(0, len(pred_codes), chunk_size)]
+    parts = [part_location(app_loc, i) for i in range(len(ranges))]
+    payload = pickle.dumps((columns, levels, model, enc))
+    logger.info("Scoring {} chunks with {} worker processes".format(len(ranges), workers))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_scoring_worker, initargs=(payload,)) as executor:
+        futures = [executor.submit(score_part, start, stop, part, save_proba, data_format)
+                   for (start, stop), part in zip(ranges, parts)]
+        for future in as_completed(futures):
+            start, stop, codes, proba = future.result()
+            pred_codes[start:stop] = codes
+            if save_proba:
+                pred_proba[start:stop] = proba
+            logger.debug("Scored and wrote combinations {}-{}".format(start, stop - 1))
+    write_manifest(app_loc, parts, [stop - start for start, stop in ranges])
+    return pred_codes, pred_proba
+
+# model, encoder and feature levels of a scoring worker process, set once by init_scoring_worker
+_scoring_worker = {}
 
+def init_scoring_worker(payload):
+    """Helper function for score_combinations_parallel - unpickle the shared scoring state once per worker."""
+    _scoring_worker["columns"], _scoring_worker["levels"], _scoring_worker["model"], _scoring_worker["enc"] = \
+        pickle.loads(payload)
 
+def score_part(start, stop, part_loc, save_proba, data_format=None):
+    """
+    Helper function for score_combinations_parallel - score combinations `start` to `stop` in a worker and write them
+    with their predicted classes to `part_loc`.
+
+    Returns:
+        start, stop, predicted class codes and class probabilities (None unless `save_proba`) of the range.
+    """
+    columns, levels, model, enc = (_scoring_worker[k] for k in ("columns", "levels", "model", "enc"))
+    codes = combination_range(levels, start, stop)
+    pred_codes, pred_proba = score_codes(codes, columns, levels, model, enc, save_proba)
+    unique_data = decode_combinations(codes, columns, levels)
+    unique_data["pred"] = pd.Categorical.from_codes(pred_codes, categories=model.classes_)
+    write_table(unique_data, part_loc, data_format)
+    return start, stop, pred_codes, pred_proba
+
+def empty_predictions(levels, model, chunk_size, save_proba):
+    """Helper function for score_combinations - allocate the class code (and probability) arrays of all combinations."""
+    n_combinations = int(np.prod([len(lev) for lev in levels]))
+    logger.info("Scoring {} unique feature combinations in chunks of {}".format(n_combinations, chunk_size))
+    pred_codes = np.empty(n_combinations, dtype=np.min_scalar_type(len(model.classes_)))
+    pred_proba = np.empty((n_combinations, len(model.classes_)), dtype=np.float32) if save_proba else None
+    return pred_codes, pred_proba
+
+def score_codes(codes, columns, levels, model, enc, save_proba=False):
+    """
+    Helper function for score_combinations - encode and score a chunk of combinations (from their codes, without
+    building their labels).
+    Args:
+        codes (2d array): Category codes, one column per feature.
+        columns (list): Feature names, in column order.
+        levels (list of arrays): Category levels of each feature, in column order.
+        model (trained mode object): Trained model object to predict classes.
+        enc (Encoder): OneHotEncoder trained on training dataset.
+        save_proba (bool, default False): Whether to also return class probabilities.
+
+    Returns:
+        pred_codes, pred_proba - index of the predicted class in `model.classes_` for each row, and the class
+        probabilities (None unless `save_proba`).
+    """
+    unique_data_enc = encode_codes(codes, levels, enc)
+    pred_codes = np.searchsorted(model.classes_, model.predict(unique_data_enc))
+    pred_proba = model.predict_proba(unique_data_enc) if save_proba else None
+    return pred_codes, pred_proba
+
+def write_app_data(app_loc, columns, levels, classes, pred_codes, chunk_size, data_format=None):
+    """
+    Helper function for unique_data_combinations - write the combination table from the predicted class codes.
+    Args:
+        app_loc (str): Filepath to save all combinations of input features with their predicted responses.
+        columns (list): Feature names, in column order.
+        levels (list of arrays): Category levels of each feature, in column order.
+        classes (array): Class labels, indexed by class code.
+        pred_codes (1d array): Predicted class code of each combination, indexed by combination id.
+        chunk_size (int): Number of combinations to write at a time.
+        data_format (str, default None): Format to write in - taken from the extension of `app_loc` if None.
 
+    Returns:
+        None.
+    """
+    with TableWriter(app_loc, data_format) as writer:
+        for i, codes in enumerate(combination_chunks(levels, chunk_size)):
+            unique_data = decode_combinations(codes, columns, levels)
+            unique_data["pred"] = pd.Categorical.from_codes(pred_codes[i * chunk_size:i * chunk_size + len(codes)],
+                                                            categories=classes)
+            writer.write(unique_data)
+
+def combination_chunks(levels, chunk_size):
+    """
+    Generate the cartesian product of feature levels as chunks of integer category codes.
+
+    Combination `i` is the mixed-radix number whose digits are the category codes of each feature (the first feature
+    varies slowest), so any chunk can be produced from its index range alone.
+    Args:
+        levels (list of arrays): Category levels of each feature, in column order.
+        chunk_size (int): Maximum number of combinations per chunk.
+
+    Yields:
+        2d integer array of shape (rows in chunk, number of features) with the category code of each feature.
+    """
+    n_combinations = int(np.prod([len(lev) for lev in levels]))
+    for start in range(0, n_combinations, chunk_size):
+        yield combination_range(levels, start, min(start + chunk_size, n_combinations))
+
+def combination_range(levels, start, stop):
+    """Helper function for combination_chunks - category codes of combinations `start` to `stop` (exclusive)."""
+    return np.stack(np.unravel_index(np.arange(start, stop), [len(lev) for lev in levels]), axis=1)
+
+def decode_combinations(codes, columns, levels):
+    """
+    Helper function for unique_data_combinations - turn category codes back into a dataframe of (categorical) labels.
+    Args:
+        codes (2d array): Category codes, one column per feature.
+        columns (list): Feature names, in column order.
+        levels (list of arrays): Category levels of each feature, in column order.
+
+    Returns:
+        Dataframe of category labels with one column per feature.
+    """
+    return pd.DataFrame({col: pd.Categorical.from_codes(codes[:, j], categories=levels[j]) for j, col in enumerate(columns)})
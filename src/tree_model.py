@@ -0,0 +1,230 @@
+import json
+import logging
+import os
+import numpy as np
+from scipy.special import expit, logsumexp
+from src.vocab import level_codes
+
+logger = logging.getLogger('tree_model')
+
+# arrays of the artifact, each saved as <name>.npy in the artifact directory
+ARRAYS = ["feature", "threshold", "left", "right", "value", "roots", "init", "column_feature", "column_level"]
+
+def link_function(model):
+    """How a fitted GradientBoostingClassifier turns raw predictions into class probabilities, from its `loss` and
+    `classes_`."""
+    if model.loss == "exponential":
+        return "exponential"
+    return "softmax" if len(model.classes_) > 2 else "logistic"
+
+def init_raw_predictions(model, link, n_columns):
+    """
+    Raw predictions the boosting starts from, computed from the fitted init estimator (`init_`) as scikit-learn does.
+    Args:
+        model (GradientBoostingClassifier): Fitted model, with the default (prior) or "zero" init estimator.
+        link (str): Link function of the model, see `link_function`.
+        n_columns (int): Number of columns the model was fitted on.
+
+    Returns:
+        1d float array with a value per tree of each stage - the same for every input.
+    """
+    n_trees = model.estimators_.shape[1]
+    if isinstance(model.init_, str):
+        return np.zeros(n_trees, dtype=np.float64)
+    proba = model.init_.predict_proba(np.zeros((1, n_columns)))[0]
+    eps = np.finfo(np.float32).eps
+    if link == "softmax":
+        return np.log(np.clip(proba, eps, 1 - eps)).astype(np.float64)
+    proba_pos_class = np.clip(proba[1:], eps, 1 - eps)
+    raw = np.log(proba_pos_class / (1 - proba_pos_class))
+    return (0.5 * raw if link == "exponential" else raw).astype(np.float64)
+
+def export_model(model, enc, artifact_loc):
+    """
+    Compile a fitted GradientBoostingClassifier and its OneHotEncoder into flat NumPy arrays.
+
+    The nodes of all trees are concatenated: `feature`, `threshold`, `left` and `right` (child indices into the same
+    arrays, -1 at leaves) and `value` (the leaf values); `roots` holds the root node of each tree by stage and class.
+    The encoder is reduced to the feature and category code behind each one-hot column, so inputs are scored from
+    their category codes without building the one-hot matrix.
+    Args:
+        model (GradientBoostingClassifier): Fitted model, with the default (prior) init estimator.
+        enc (OneHotEncoder): Fitted encoder the model was trained with.
+        artifact_loc (str): Directory to save the arrays (.npy) and metadata (meta.json) in.
+
+    Returns:
+        None.
+    """
+    if model.init not in (None, "zero"):
+        raise ValueError("Only models with the default init estimator can be exported")
+    link = link_function(model)
+    n_columns = sum(len(cats) for cats in enc.categories_)
+    # the prior init estimator predicts the same raw values for every input
+    init = init_raw_predictions(model, link, n_columns)
+
+    feature, threshold, left, right, value = [], [], [], [], []
+    roots = np.empty(model.estimators_.shape, dtype=np.int64)
+    offset = 0
+    for stage in range(model.estimators_.shape[0]):
+        for k in range(model.estimators_.shape[1]):
+            tree = model.estimators_[stage, k].tree_
+            roots[stage, k] = offset
+            feature.append(tree.feature)
+            threshold.append(tree.threshold)
+            left.append(np.where(tree.children_left == -1, -1, tree.children_left + offset))
+            right.append(np.where(tree.children_right == -1, -1, tree.children_right + offset))
+            value.append(tree.value[:, 0, 0])
+            offset += tree.node_count
+
+    arrays = {"feature": np.concatenate(feature).astype(np.int32),
+              "threshold": np.concatenate(threshold),
+              "left": np.concatenate(left).astype(np.int32),
+              "right": np.concatenate(right).astype(np.int32),
+              "value": np.concatenate(value),
+              "roots": roots,
+              "init": init,
+              "column_feature": np.repeat(np.arange(len(enc.categories_)), [len(c) for c in enc.categories_]),
+              "column_level": np.concatenate([np.arange(len(c)) for c in enc.categories_])}
+    os.makedirs(artifact_loc, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(artifact_loc, name + ".npy"), arrays[name])
+    meta = {"features": [str(f) for f in enc.feature_names_in_],
+            "levels": [[str(lev) for lev in cats] for cats in enc.categories_],
+            "classes": [str(c) for c in model.classes_],
+            "link": link,
+            "learning_rate": model.learning_rate,
+            "max_depth": int(max(est.tree_.max_depth for est in model.estimators_.ravel()))}
+    with open(os.path.join(artifact_loc, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    logger.info("Model exported to {} ({} trees, {} nodes)".format(artifact_loc, roots.size, offset))
+
+class TreeModel:
+    """Gradient boosted trees exported with `export_model`, scored with NumPy alone.
+
+    Gives the same probabilities as the sklearn model it was exported from: the trees are walked level by level for
+    all inputs at once, the leaf values are accumulated stage by stage in the same order as sklearn, and the raw
+    predictions go through the same scipy link functions.
+    """
+
+    def __init__(self, arrays, meta):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.features = meta["features"]
+        self.levels = meta["levels"]
+        self.classes = np.asarray(meta["classes"], dtype=object)
+        self.link = meta["link"]
+        self.learning_rate = meta["learning_rate"]
+        self.max_depth = meta["max_depth"]
+
+    @classmethod
+    def load(cls, artifact_loc, mmap=True):
+        """
+        Load a model saved with `export_model`.
+        Args:
+            artifact_loc (str): Directory the model was exported to.
+            mmap (bool, default True): Whether to memory-map the arrays rather than read them into memory.
+
+        Returns:
+            TreeModel.
+        """
+        with open(os.path.join(artifact_loc, "meta.json")) as f:
+            meta = json.load(f)
+        mmap_mode = "r" if mmap else None
+        arrays = {name: np.load(os.path.join(artifact_loc, name + ".npy"), mmap_mode=mmap_mode) for name in ARRAYS}
+        logger.info("Model loaded from {} ({} trees)".format(artifact_loc, arrays["roots"].size))
+        return cls(arrays, meta)
+
+    def level_codes(self, data):
+        """
+        Category codes of inputs - -1 where a feature is missing or its level was not seen in training.
+        Args:
+            data (dataframe): Level of each feature, one row per input, with a column per feature name.
+
+        Returns:
+            2d int array with a row per input and a column per feature.
+        """
+        return level_codes(data, self.features, self.levels)
+
+    def raw_predict(self, codes):
+        """
+        Raw predictions (before the link function) of inputs given as category codes.
+        Args:
+            codes (2d int array): Category code of each feature, one row per input (-1 for unknown levels, which like
+                the encoder's handle_unknown='ignore' set none of the feature's columns).
+
+        Returns:
+            2d float array with a row per input and a column per tree of each stage.
+        """
+        n_stages, n_k = self.roots.shape
+        rows = np.arange(len(codes))[:, np.newaxis]
+        node = np.broadcast_to(np.asarray(self.roots).ravel(), (len(codes), self.roots.size)).copy()
+        for _ in range(self.max_depth):
+            feature = self.feature[node]
+            leaf = feature < 0
+            if leaf.all():
+                break
+            column = np.where(leaf, 0, feature)
+            # one-hot value of the split's column, compared as float32 like sklearn's trees
+            x = (codes[rows, self.column_feature[column]] == self.column_level[column]).astype(np.float32)
+            child = np.where(x <= self.threshold[node], self.left[node], self.right[node])
+            node = np.where(leaf, node, child)
+        leaf_values = np.asarray(self.value)[node].reshape(len(codes), n_stages, n_k)
+
+        raw = np.tile(np.asarray(self.init, dtype=np.float64), (len(codes), 1))
+        for stage in range(n_stages):
+            raw += self.learning_rate * leaf_values[:, stage, :]
+        return raw
+
+    def predict_proba_codes(self, codes):
+        """
+        Class probabilities of inputs given as category codes.
+        Args:
+            codes (2d int array): Category code of each feature, one row per input.
+
+        Returns:
+            2d float array with a row per input and a column per class.
+        """
+        raw = self.raw_predict(codes)
+        if self.link == "softmax":
+            return np.nan_to_num(np.exp(raw - logsumexp(raw, axis=1)[:, np.newaxis]))
+        scale = 2.0 if self.link == "exponential" else 1.0
+        proba = np.ones((len(raw), 2), dtype=np.float64)
+        proba[:, 1] = expit(scale * raw.ravel())
+        proba[:, 0] -= proba[:, 1]
+        return proba
+
+    def predict_proba(self, data):
+        """
+        Class probabilities of inputs.
+        Args:
+            data (dataframe): Level of each feature, one row per input, with a column per feature name.
+
+        Returns:
+            2d float array with a row per input and a column per class.
+        """
+        return self.predict_proba_codes(self.level_codes(data))
+
+    def predict_codes(self, codes):
+        """
+        Predicted classes of inputs given as category codes.
+        Args:
+            codes (2d int array): Category code of each feature, one row per input.
+
+        Returns:
+            1d object array of class labels.
+        """
+        if self.link == "exponential":
+            # sklearn decides exponential loss models on the sign of the raw prediction
+            return self.classes[(self.raw_predict(codes).ravel() >= 0).astype(int)]
+        return self.classes[np.argmax(self.predict_proba_codes(codes), axis=1)]
+
+    def predict(self, data):
+        """
+        Predicted classes of inputs.
+        Args:
+            data (dataframe): Level of each feature, one row per input, with a column per feature name.
+
+        Returns:
+            1d object array of class labels.
+        """
+        return self.predict_codes(self.level_codes(data))
@@ -0,0 +1,120 @@
+import json
+import logging
+import re
+import fsspec
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+logger = logging.getLogger('vocab')
+
+def collect_vocab(data, columns, vocab=None):
+    """
+    Category vocabulary of columns - the sorted labels of each column, as strings.
+    Args:
+        data (dataframe): Data to take the labels from.
+        columns (list): Columns to collect labels of (columns not in `data` are skipped).
+        vocab (dict, default None): Vocabulary to add the labels to, e.g. of earlier chunks of the same data.
+
+    Returns:
+        dict of sorted label lists, keyed by column.
+    """
+    vocab = dict(vocab or {})
+    for col in columns:
+        if col in data:
+            labels = data[col].dropna().astype(str).unique()
+            vocab[col] = sorted(set(vocab.get(col, [])) | set(labels))
+    return vocab
+
+def save_vocab(vocab_loc, vocab):
+    """
+    Save a category vocabulary.
+    Args:
+        vocab_loc (str): Filepath to save the vocabulary to (.json).
+        vocab (dict): Sorted label lists, keyed by column.
+
+    Returns:
+        None.
+    """
+    with fsspec.open(vocab_loc, "w") as f:
+        json.dump(vocab, f, indent=1)
+    logger.info("Vocabulary of {} columns saved to {}".format(len(vocab), vocab_loc))
+
+def read_vocab(vocab_loc):
+    """
+    Load a category vocabulary saved with `save_vocab`.
+    Args:
+        vocab_loc (str): Filepath of the vocabulary (.json).
+
+    Returns:
+        dict of sorted label lists, keyed by column.
+    """
+    with fsspec.open(vocab_loc, "r") as f:
+        return json.load(f)
+
+def display_order(labels):
+    """Labels sorted for display - those starting with a number (e.g. age ranges) in numeric order, then the rest."""
+    def key(label):
+        number = re.match(r"\d+", label)
+        return (0, int(number.group()), label) if number else (1, 0, label)
+    return sorted(labels, key=key)
+
+def vocab_dtypes(vocab):
+    """Categorical dtype of each column of a vocabulary, e.g. for the `dtype` argument of `pd.read_csv`."""
+    return {col: pd.CategoricalDtype(labels) for col, labels in vocab.items()}
+
+def apply_vocab(data, vocab):
+    """
+    Convert columns to categoricals with the categories of a vocabulary.
+
+    Values are matched as strings (so booleans become "True"/"False"); values not in the vocabulary become missing.
+    Columns that already have the vocabulary's categories are left as they are.
+    Args:
+        data (dataframe): Data to convert.
+        vocab (dict): Sorted label lists, keyed by column (columns not in `data` are skipped).
+
+    Returns:
+        Dataframe with categorical columns - their codes are int8 for up to 127 labels.
+    """
+    data = data.copy()
+    for col, dtype in vocab_dtypes(vocab).items():
+        if col in data and data[col].dtype != dtype:
+            data[col] = data[col].astype(str).where(data[col].notna()).astype(dtype)
+    return data
+
+def level_codes(data, features, levels):
+    """
+    Category codes of features, matched as strings.
+    Args:
+        data (dataframe): Level of each feature, one row per input, with a column per feature name.
+        features (list): Names of the features.
+        levels (list of lists): Sorted levels of each feature.
+
+    Returns:
+        2d int array with a row per input and a column per feature - -1 where a feature is missing or a level is not
+        one of its levels.
+    """
+    codes = np.full((len(data), len(features)), -1, dtype=np.int64)
+    for i, (feature, feature_levels) in enumerate(zip(features, levels)):
+        if feature in data:
+            codes[:, i] = pd.Categorical(data[feature].map(str), categories=feature_levels).codes
+    return codes
+
+def one_hot_codes(codes, sizes):
+    """
+    One-hot encoding of category codes, as produced by a OneHotEncoder with the same categories (and
+    handle_unknown='ignore').
+    Args:
+        codes (2d int array): Category code of each feature, one row per input - -1 for missing or unknown levels,
+            which set none of the feature's columns.
+        sizes (list of int): Number of levels of each feature.
+
+    Returns:
+        CSR matrix with a row per input and a column per feature level.
+    """
+    codes = np.asarray(codes)
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+    known = codes >= 0
+    rows = np.broadcast_to(np.arange(len(codes))[:, np.newaxis], codes.shape)[known]
+    columns = (codes + offsets)[known]
+    return scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(codes), int(np.sum(sizes))))
@@ -0,0 +1,102 @@
+import functools
+import http.server
+import logging
+import threading
+import pytest
+from src import acquire_copa_data as acd
+
+# local HTTP server approach from: https://docs.python.org/3/library/http.server.html
+
+@pytest.fixture
+def data_server():
+    """Serve the test directory over HTTP on a free local port."""
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory="test")
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+def test_stream_copa_data_happy(data_server, tmp_path):
+    """Streamed download matches the served file, read in small chunks."""
+    sink = acd.LocalFileSink(str(tmp_path / "raw.csv"))
+    state = acd.stream_copa_data(data_server + "/test_data.csv", sink, chunk_size=256)
+    with open("test/test_data.csv", "rb") as f:
+        expected = f.read()
+    assert state["bytes"] == len(expected)
+    assert (tmp_path / "raw.csv").read_bytes() == expected
+
+def test_stream_copa_data_unhappy(data_server, tmp_path, caplog):
+    """When the URL does not exist."""
+    sink = acd.LocalFileSink(str(tmp_path / "raw.csv"))
+    with caplog.at_level(logging.ERROR):
+        assert acd.stream_copa_data(data_server + "/missing.csv", sink) is None
+    assert "404" in caplog.text
+
+def test_stream_copa_data_s3(data_server, monkeypatch):
+    """Multipart upload to a mocked S3 bucket."""
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        boto3.client("s3").create_bucket(Bucket="copa-test")
+        sink = acd.S3MultipartSink("copa-test", "copa_raw_data")
+        acd.stream_copa_data(data_server + "/test_data.csv", sink, chunk_size=256)
+        body = boto3.client("s3").get_object(Bucket="copa-test", Key="copa_raw_data")["Body"].read()
+    with open("test/test_data.csv", "rb") as f:
+        assert body == f.read()
+
+def test_s3_read_state_unhappy(monkeypatch, caplog):
+    """S3 errors other than a missing key (here a missing bucket) and malformed state are logged, not raised."""
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws(), caplog.at_level(logging.WARNING):
+        assert acd.S3MultipartSink("no-such-bucket", "copa_raw_data").read_state() is None
+        boto3.client("s3").create_bucket(Bucket="copa-test")
+        boto3.client("s3").put_object(Bucket="copa-test", Key="copa_raw_data" + acd.STATE_SUFFIX, Body=b"{not json")
+        assert acd.S3MultipartSink("copa-test", "copa_raw_data").read_state() is None
+    assert caplog.text.count("not read") == 2
+
+def test_acquire_copa_data_conditional(data_server, tmp_path):
+    """Second acquisition of unchanged data is skipped (not-modified response)."""
+    local_path = str(tmp_path / "raw.csv")
+    url = data_server + "/test_data.csv"
+    assert acd.acquire_copa_data(url, None, None, stream=True, local_path=local_path, conditional=True) is True
+    assert acd.acquire_copa_data(url, None, None, stream=True, local_path=local_path, conditional=True) is False
+
+def test_acquire_copa_data_same_hash_state(data_server, tmp_path):
+    """Validators are saved when unchanged data is only detected by its hash, so the next request is conditional."""
+    local_path = str(tmp_path / "raw.csv")
+    url = data_server + "/test_data.csv"
+    acd.acquire_copa_data(url, None, None, stream=True, local_path=local_path, conditional=True)
+    state = acd.LocalFileSink(local_path).read_state()
+    acd.LocalFileSink(local_path).write_state({"sha256": state["sha256"]})
+    assert acd.acquire_copa_data(url, None, None, stream=True, local_path=local_path, conditional=True) is False
+    assert acd.LocalFileSink(local_path).read_state()["last_modified"] == state["last_modified"]
+
+def test_acquire_copa_data_bad_state(data_server, tmp_path, caplog):
+    """An unreadable state file falls back to an unconditional download."""
+    local_path = str(tmp_path / "raw.csv")
+    (tmp_path / ("raw.csv" + acd.STATE_SUFFIX)).write_text("{not json")
+    with caplog.at_level(logging.WARNING):
+        assert acd.acquire_copa_data(data_server + "/test_data.csv", None, None, stream=True, local_path=local_path,
+                                     conditional=True) is True
+    assert "not read" in caplog.text
+
+def test_stream_copa_data_same_hash(data_server, tmp_path):
+    """Unchanged content is discarded when the server can't answer conditionally."""
+    sink = acd.LocalFileSink(str(tmp_path / "raw.csv"))
+    state = acd.stream_copa_data(data_server + "/test_data.csv", sink)
+    assert state["changed"]
+    previous = {"sha256": state["sha256"]}
+    (tmp_path / "raw.csv").write_bytes(b"old")
+    state = acd.stream_copa_data(data_server + "/test_data.csv", sink, previous=previous)
+    assert not state["changed"]
+    assert (tmp_path / "raw.csv").read_bytes() == b"old"
+    assert not (tmp_path / "raw.csv.part").exists()
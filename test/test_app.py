@@ -0,0 +1,50 @@
+import itertools
+import logging
+import os
+import pandas as pd
+from src import create_copa_db as ccd
+from src.vocab import save_vocab
+
+os.environ.setdefault("SQLALCHEMY_DATABASE_URI", "sqlite://")
+import app as A
+
+# the app's logging config disables the loggers that already exist - keep them for the tests that check logs
+for name in logging.root.manager.loggerDict:
+    logging.getLogger(name).disabled = False
+
+def app_client(tmp_path, monkeypatch):
+    """Test client scoring /api/predict from a database of every combination of two levels per feature."""
+    features = [f for f in ccd.APP_COLUMN_MAP if f != "pred"]
+    data = pd.DataFrame(list(itertools.product(["a", "b"], repeat=len(features))), columns=features)
+    data["pred"] = ["Sustained" if x == "a" else "Unfounded" for x in data[features[0]]]
+    data.to_csv(tmp_path / "app.csv", index=False)
+    engine_string = "sqlite:///{}".format(tmp_path / "copa.db")
+    ccd.create_copa_db(engine_string, str(tmp_path / "app.csv"), batch_size=100)
+    save_vocab(str(tmp_path / "vocab.json"), {"FINDING_CODE": ["Not Sustained", "Sustained", "Unfounded"]})
+
+    monkeypatch.setitem(A.app.config, "SQLALCHEMY_DATABASE_URI", engine_string)
+    monkeypatch.setitem(A.app.config, "VOCAB_LOCATION", str(tmp_path / "vocab.json"))
+    monkeypatch.setattr(A, "lookup", None)
+    monkeypatch.setattr(A, "load_model", lambda: None)
+    monkeypatch.setattr(A, "data_version_checked", float("-inf"))
+    return A.app.test_client()
+
+def test_api_predict_db(tmp_path, monkeypatch):
+    """Cases scored from the database get a prediction, or an error for unseen or missing values, with every class."""
+    client = app_client(tmp_path, monkeypatch)
+    case = {f: "a" for f in A.FIELD_LIST}
+    response = client.post("/api/predict", json=[case, dict(case, police_shooting="c"),
+                                                 {f: "a" for f in A.FIELD_LIST[1:]}])
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result["classes"] == ["Not Sustained", "Sustained", "Unfounded"]
+    assert result["predictions"][0] == {"pred_outcome": "Sustained"}
+    assert [p["pred_outcome"] for p in result["predictions"][1:]] == [None, None]
+    assert all("error" in p for p in result["predictions"][1:])
+
+def test_api_predict_unhappy(tmp_path, monkeypatch):
+    """A request body that is not an array of cases is rejected."""
+    client = app_client(tmp_path, monkeypatch)
+    response = client.post("/api/predict", json={f: "a" for f in A.FIELD_LIST})
+    assert response.status_code == 400
+    assert "error" in response.get_json()
@@ -1,4 +1,5 @@
 import logging
+import numpy as np
 import pandas as pd
 import pytest
 from src import clean_copa_data as ccd
@@ -84,3 +85,63 @@ def test_make_excessive_force_unhappy(caplog):
     with caplog.at_level(logging.ERROR):
         ccd.make_excessive_force(pd.DataFrame())
     assert "CURRENT_CATEGORY" in caplog.text
+
+def test_drop_invalid_happy(caplog):
+    """All rules applied in one selection, with per-rule drop counts logged."""
+    data = pd.read_csv("test/test_data.csv")
+    with caplog.at_level(logging.INFO):
+        data_clean = ccd.drop_invalid(data)
+    assert len(data_clean) == len(data) - 1
+    assert "Rule 'multiples' drops 1 rows" in caplog.text
+
+def test_drop_invalid_missing_finding(caplog):
+    """Rows without a finding are dropped as NAs."""
+    data = pd.read_csv("test/test_data.csv")
+    data.loc[0, 'FINDING_CODE'] = np.nan
+    with caplog.at_level(logging.INFO):
+        data_clean = ccd.drop_invalid(data)
+    assert data_clean['FINDING_CODE'].notna().all()
+    assert len(data_clean) == len(data) - 2
+    assert "Rule 'NAs' drops 2 rows" in caplog.text
+
+def test_drop_invalid_unhappy(caplog):
+    """When columns are missing."""
+    with caplog.at_level(logging.ERROR):
+        ccd.drop_invalid(pd.DataFrame())
+    assert "COMPLAINT_DATE" in caplog.text
+
+def test_clean_copa_data_chunked(tmp_path):
+    """Cleaning in chunks keeps the same rows as cleaning the whole file, with only the needed columns."""
+    full_loc = str(tmp_path / "clean_full.csv")
+    chunked_loc = str(tmp_path / "clean_chunked.csv")
+    ccd.clean_copa_data("test/test_data.csv", full_loc)
+    ccd.clean_copa_data("test/test_data.csv", chunked_loc, chunk_size=6, columns=["POLICE_SHOOTING", "EXCESSIVE_FORCE"],
+                        date_format="%m/%d/%y %H:%M")
+    full = pd.read_csv(full_loc)
+    chunked = pd.read_csv(chunked_loc)
+    assert "BEAT" not in chunked and "POLICE_SHOOTING" in chunked
+    pd.testing.assert_frame_equal(chunked, full[chunked.columns])
+
+def test_clean_copa_data_chunked_feather(tmp_path):
+    """Chunks with different categories can be written to one Feather file."""
+    csv_loc = str(tmp_path / "clean.csv")
+    feather_loc = str(tmp_path / "clean.feather")
+    for location in [csv_loc, feather_loc]:
+        ccd.clean_copa_data("test/test_data.csv", location, chunk_size=6, columns=["POLICE_SHOOTING", "EXCESSIVE_FORCE"],
+                            date_format="%m/%d/%y %H:%M")
+    chunked = pd.read_feather(feather_loc)
+    expected = pd.read_csv(csv_loc, parse_dates=["COMPLAINT_DATE"])
+    pd.testing.assert_frame_equal(chunked.fillna(np.nan), expected, check_dtype=False)
+
+def test_load_data_chunks_unhappy(tmp_path, caplog):
+    """Dates not in the given format are logged and read as missing - a chunk with none in the format is an error."""
+    data = pd.read_csv("test/test_data.csv")
+    data.loc[0, "COMPLAINT_DATE"] = "2020-01-01"
+    data.to_csv(tmp_path / "raw.csv", index=False)
+    with caplog.at_level(logging.WARNING):
+        chunks = list(ccd.load_data_chunks(str(tmp_path / "raw.csv"), 10, date_format="%m/%d/%y %H:%M"))
+    assert len(chunks) == 2 and pd.isna(chunks[0].loc[0, "COMPLAINT_DATE"])
+    assert chunks[0]["COMPLAINT_DATE"].notna().sum() == 9
+    assert "1 dates could not be parsed" in caplog.text
+    with pytest.raises(ValueError):
+        list(ccd.load_data_chunks("test/test_data.csv", 10, date_format="%Y-%m-%d"))
@@ -0,0 +1,70 @@
+import itertools
+import pandas as pd
+import sqlalchemy as sql
+from src import create_copa_db as ccd
+from src.case_codes import CaseCodec
+
+def app_data(path):
+    """Write a small unique-combination dataset (every combination of two levels per feature) with predictions."""
+    features = [f for f in ccd.APP_COLUMN_MAP if f != "pred"]
+    data = pd.DataFrame(list(itertools.product(["a", "b"], repeat=len(features))), columns=features)
+    data["pred"] = ["Sustained" if x == "a" else "Unfounded" for x in data[features[0]]]
+    data.to_csv(path, index=False)
+    return data
+
+def test_write_rollup_to_db(tmp_path):
+    """Rolled-up counts match a group-by of the data, for a partial and an empty selection."""
+    data = app_data(tmp_path / "app.csv")
+    engine_string = "sqlite:///{}".format(tmp_path / "copa.db")
+    ccd.create_db(engine_string)
+    ccd.write_rollup_to_db(engine_string, str(tmp_path / "app.csv"), batch_size=100)
+    rollup = pd.read_sql_table("copa_outcome_rollup", sql.create_engine(engine_string))
+
+    searched = ccd.APP_COLUMN_MAP["SEX_OF_COMPLAINANTS"]
+    cells = rollup[(rollup.grouping_id == ccd.rollup_grouping_id([searched])) & (rollup[searched] == "b")]
+    expected = data[data.SEX_OF_COMPLAINANTS == "b"].pred.value_counts()
+    assert dict(zip(cells.pred_outcome, cells["count"])) == expected.to_dict()
+    everything = rollup[rollup.grouping_id == ccd.rollup_grouping_id([])]
+    assert everything["count"].sum() == len(data)
+    assert everything[ccd.ROLLUP_COLUMNS].isna().all().all()
+
+def test_write_data_to_db_codes(tmp_path):
+    """Cases loaded as codes decode back to the labels of the data."""
+    data = app_data(tmp_path / "app.csv")
+    engine_string = "sqlite:///{}".format(tmp_path / "copa.db")
+    ccd.create_db(engine_string)
+    levels = ccd.collect_levels(str(tmp_path / "app.csv"))
+    ccd.write_levels_to_db(engine_string, levels)
+    ccd.write_data_to_db(engine_string, str(tmp_path / "app.csv"), batch_size=100, levels=levels)
+    engine = sql.create_engine(engine_string)
+    codec = CaseCodec(ccd.read_levels(engine))
+    codes = pd.read_sql_table("copa_case_codes", engine)
+    decoded = pd.DataFrame([codec.decode(record) for record in codes.to_dict("records")])
+    assert (decoded.drop(columns="id").values == data.rename(columns=ccd.APP_COLUMN_MAP)[ccd.CODED_COLUMNS].values).all()
+    assert codec.encode("pred_outcome", "Sustained") == 0 and codec.encode("pred_outcome", "Other") is None
+
+def test_create_copa_db_swap(tmp_path):
+    """Reloading swaps in a new version of the table, keeping the previous one for rollback."""
+    data = app_data(tmp_path / "app.csv")
+    engine_string = "sqlite:///{}".format(tmp_path / "copa.db")
+    first = ccd.create_copa_db(engine_string, str(tmp_path / "app.csv"), batch_size=100, indexes=[["police_shooting"]])
+    second = ccd.create_copa_db(engine_string, str(tmp_path / "app.csv"), batch_size=100, indexes=[["police_shooting"]])
+    engine = sql.create_engine(engine_string)
+    assert first and second and second != first
+    assert ccd.read_data_version(engine) == second
+    assert len(pd.read_sql_table("copa_case_attributes", engine)) == len(data)
+    assert "copa_case_attributes_previous" in sql.inspect(engine).get_table_names()
+    assert ccd.rollback_copa_db(engine_string) not in (None, second)
+    indexes = [ix["name"] for ix in sql.inspect(engine).get_indexes("copa_case_attributes")]
+    assert indexes == ["ix_copa_search_0_{}".format(first[:8])]
+
+def test_swap_tables_unhappy(tmp_path):
+    """A swap that fails part-way changes nothing."""
+    app_data(tmp_path / "app.csv")
+    engine_string = "sqlite:///{}".format(tmp_path / "copa.db")
+    version = ccd.create_copa_db(engine_string, str(tmp_path / "app.csv"), batch_size=100)
+    ccd.create_staging_tables(engine_string, [ccd.staging_table(ccd.COPA_Case_Attributes.__table__, "v2")])
+    assert ccd.swap_tables(engine_string, ["copa_case_attributes", "copa_outcome_rollup"], "v2") is None
+    engine = sql.create_engine(engine_string)
+    assert ccd.read_data_version(engine) == version
+    assert len(pd.read_sql_table("copa_case_attributes", engine)) == 2 ** 9
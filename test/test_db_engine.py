@@ -0,0 +1,61 @@
+import pytest
+import sqlite3
+import sqlalchemy as sql
+from src import db_engine
+
+def test_get_engine_happy(tmp_path):
+    """Engines are shared per database and report their pool's checkouts."""
+    engine_string = "sqlite:///{}".format(tmp_path / "copa.db")
+    engine = db_engine.get_engine(engine_string)
+    assert db_engine.get_engine(engine_string) is engine
+    with engine.connect() as conn:
+        conn.execute(sql.text("create table t (x integer)"))
+        assert db_engine.pool_status(engine)["checked_out"] == 1
+    status = db_engine.pool_status(engine)
+    assert status["pool"] == "TimedQueuePool" and status["checked_out"] == 0 and status["checkouts"] == 1
+    db_engine.dispose_engines(engine_string)
+    assert db_engine.get_engine(engine_string) is not engine
+
+def test_get_engine_unhappy(tmp_path):
+    """Read-only engines can't write."""
+    engine_string = "sqlite:///{}".format(tmp_path / "copa.db")
+    with db_engine.get_engine(engine_string).begin() as conn:
+        conn.execute(sql.text("create table t (x integer)"))
+    with pytest.raises(sql.exc.OperationalError):
+        with db_engine.get_engine(engine_string, read_only=True).begin() as conn:
+            conn.execute(sql.text("insert into t values (1)"))
+    db_engine.dispose_engines()
+
+def test_get_engine_read_only_reset(tmp_path):
+    """Connections stay read-only after the pool resets them on check-in and hands them out again."""
+    engine_string = "sqlite:///{}".format(tmp_path / "copa.db")
+    with db_engine.get_engine(engine_string).begin() as conn:
+        conn.execute(sql.text("create table t (x integer)"))
+    engine = db_engine.get_engine(engine_string, read_only=True, pool_size=1, max_overflow=0)
+    with engine.connect() as conn:
+        first = conn.connection.dbapi_connection
+    with pytest.raises(sql.exc.OperationalError):
+        with engine.begin() as conn:
+            assert conn.connection.dbapi_connection is first
+            conn.execute(sql.text("insert into t values (1)"))
+    db_engine.dispose_engines()
+
+def test_get_engine_read_only_commit(tmp_path):
+    """The read-only statement is committed, so the pool's rollback on check-in doesn't undo it."""
+    calls = []
+
+    class Connection:
+        def __init__(self, connection):
+            self._connection = connection
+
+        def __getattr__(self, name):
+            calls.append(name)
+            return getattr(self._connection, name)
+
+    path = tmp_path / "copa.db"
+    engine = db_engine.get_engine("sqlite:///{}".format(path), read_only=True,
+                                  creator=lambda: Connection(sqlite3.connect(path, check_same_thread=False)))
+    with engine.connect() as conn:
+        conn.execute(sql.text("select 1"))
+    assert "commit" in calls and "rollback" in calls[calls.index("commit"):]
+    db_engine.dispose_engines()
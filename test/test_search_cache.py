@@ -0,0 +1,31 @@
+from src.search_cache import SearchCache, normalize_selection
+
+def test_normalize_selection():
+    """Empty fields are dropped and values stripped, in field order whatever the form order."""
+    form = {"race_officers": " White ", "police_shooting": "Yes", "excessive_force": ""}
+    assert normalize_selection(form, ["police_shooting", "race_officers", "excessive_force"]) == \
+        (("police_shooting", "Yes"), ("race_officers", "White"))
+
+def test_search_cache_happy():
+    """Least recently used entry is evicted beyond maxsize and hits are counted."""
+    cache = SearchCache(maxsize=2)
+    cache.put("a", [{"x": "1"}])
+    cache.put("b", [])
+    cache.get("a")
+    cache.put("c", [])
+    assert cache.get("b") is None
+    assert cache.get("a") == [{"x": "1"}]
+    stats = cache.stats()
+    assert stats["entries"] == 2 and stats["hits"] == 2 and stats["misses"] == 1
+
+def test_search_cache_unhappy():
+    """Expired entries and entries from an older data version are not served."""
+    cache = SearchCache(ttl=-1)
+    cache.put("a", [])
+    assert cache.get("a") is None
+    cache = SearchCache()
+    cache.set_version("v1")
+    cache.put("a", [])
+    cache.set_version("v2")
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 0
@@ -0,0 +1,17 @@
+from src import search_planner as sp
+
+INDEXES = {"ix_a": ["race_complainants", "race_officers", "police_shooting"],
+           "ix_b": ["race_complainants", "sex_complainants"],
+           "ix_c": ["police_shooting", "excessive_force"]}
+
+def test_choose_index_happy():
+    """Index with the most selective run of searched leading columns is chosen."""
+    n_levels = {"race_complainants": 9, "race_officers": 7, "sex_complainants": 4, "police_shooting": 2}
+    assert sp.choose_index({"race_complainants", "race_officers"}, INDEXES, n_levels) == "ix_a"
+    assert sp.choose_index({"race_complainants", "sex_complainants"}, INDEXES, n_levels) == "ix_b"
+    assert sp.choose_index({"police_shooting", "excessive_force"}, INDEXES, n_levels) == "ix_c"
+
+def test_choose_index_unhappy():
+    """No index starts with a searched column."""
+    assert sp.choose_index({"age_officers"}, INDEXES) is None
+    assert sp.choose_index(set(), INDEXES) is None
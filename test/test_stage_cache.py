@@ -0,0 +1,22 @@
+import os
+from src.stage_cache import StageCache
+
+def test_run_stage_happy(tmp_path):
+    """A stage that wrote its outputs is reused while its fingerprint and state are unchanged."""
+    out = tmp_path / "out.csv"
+    cache = StageCache(str(tmp_path / "cache.json"))
+    stage = dict(inputs=[], config={}, keys=[], code=[], outputs=[str(out)], state=lambda: "v1")
+    assert cache.run_stage("clean", lambda: out.write_text("x") and "v1", **stage)
+    assert not StageCache(str(tmp_path / "cache.json")).run_stage("clean", lambda: None, **stage)
+    stage["state"] = lambda: "v2"
+    assert StageCache(str(tmp_path / "cache.json")).run_stage("clean", lambda: "v2", **stage)
+
+def test_run_stage_unhappy(tmp_path):
+    """A stage that left the previous run's outputs in place is not recorded as done."""
+    out = tmp_path / "out.csv"
+    out.write_text("previous run")
+    os.utime(out, (0, 0))
+    cache = StageCache(str(tmp_path / "cache.json"))
+    stage = dict(inputs=[], config={}, keys=[], code=[], outputs=[str(out)])
+    assert cache.run_stage("clean", lambda: None, **stage)
+    assert cache.run["clean"] == "failed" and "clean" not in cache.stages
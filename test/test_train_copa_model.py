@@ -1,8 +1,13 @@
+import json
 import logging
 import pandas as pd
 import pytest
 import sklearn
+import sklearn.metrics
 from src import train_copa_model as tcm
+from src.data_io import dataset_parts, write_table
+from src.prediction_lookup import PredictionLookup
+from src.vocab import apply_vocab, collect_vocab, one_hot_codes
 
 def test_train_test_split_happy():
     X_train, X_test, y_train, y_test = tcm.train_test_split("test/test_data.csv", ['ASSIGNMENT', 'CURRENT_CATEGORY'], 'FINDING_CODE', 4, .5)
@@ -19,6 +24,30 @@ def test_encode_data_happy():
     denc, denc2, xenc = tcm.encode_data(data[['SEX_OF_COMPLAINANTS', 'CASE_TYPE']], data[['ASSIGNMENT', 'CASE_TYPE']])
     assert denc.shape[1] == 3
 
+def test_encode_data_sparse():
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    denc, denc2, xenc = tcm.encode_data(data[['SEX_OF_COMPLAINANTS', 'CASE_TYPE']], data[['ASSIGNMENT', 'CASE_TYPE']],
+                                        sparse=True)
+    assert denc.format == "csr"
+    assert denc.shape[1] == 3
+    assert (denc.sum(axis=1) == 2).all()
+
+def test_encode_data_categorical():
+    """Categorical features are encoded from their codes, the same as their labels."""
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    features = ['SEX_OF_COMPLAINANTS', 'AGE_OF_COMPLAINANTS', 'EXCESSIVE_FORCE']
+    labels = data[features].astype(str)
+    coded = apply_vocab(labels, collect_vocab(labels, features))
+    for sparse in (False, True):
+        denc, denc2, xenc = tcm.encode_data(coded.iloc[:10], coded.iloc[10:], sparse=sparse)
+        ldenc, ldenc2, lxenc = tcm.encode_data(labels.iloc[:10], labels.iloc[10:], sparse=sparse)
+        assert [list(c) for c in xenc.categories_] == [list(c) for c in lxenc.categories_]
+        if sparse:
+            denc2, ldenc2 = denc2.toarray(), ldenc2.toarray()
+        assert (pd.DataFrame(denc2).values == pd.DataFrame(ldenc2).values).all()
+
 def test_encode_data_unhappy(caplog):
     data = pd.read_csv("test/test_data.csv")
     with caplog.at_level(logging.ERROR):
@@ -39,4 +68,166 @@ def test_fit_model_unhappy(caplog):
 
     with caplog.at_level(logging.ERROR):
         tcm.fit_model(denc, denc2, 14)
-    assert "shape" in caplog.text
\ No newline at end of file
+    assert "shape" in caplog.text
+
+def test_fit_model_hist(tmp_path):
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    features = ['SEX_OF_COMPLAINANTS', 'AGE_OF_COMPLAINANTS', 'EXCESSIVE_FORCE']
+    denc, denc2, xenc = tcm.encode_data(data[features], data[features], backend="hist_gradient_boosting")
+    assert denc.shape[1] == len(features)
+    model = tcm.fit_model(denc, data['FINDING_CODE'], 14, backend="hist_gradient_boosting")
+    assert "HistGradientBoostingClassifier" in str(type(model))
+    assert model.is_categorical_.all()
+
+    # the combination table and lookup are scored through the ordinal encoder
+    app_loc = str(tmp_path / "app_data.csv")
+    tcm.unique_data_combinations(data[features], model, xenc, app_loc, chunk_size=4)
+    unique_data = pd.read_csv(app_loc)
+    assert (unique_data["pred"] == model.predict(xenc.transform(unique_data[features].astype(str)))).all()
+
+    runs_loc = str(tmp_path / "runs.csv")
+    for _ in range(2):
+        tcm.record_run(runs_loc, "hist_gradient_boosting", "FINDING_CODE", len(data), 0.5, 0.4)
+    assert len(pd.read_csv(runs_loc)) == 2
+
+def test_search_hyperparameters_happy(tmp_path):
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    denc, denc2, xenc = tcm.encode_data(data[['SEX_OF_COMPLAINANTS', 'CASE_TYPE']], data[['ASSIGNMENT', 'CASE_TYPE']])
+    leaderboard_loc = str(tmp_path / "leaderboard.csv")
+    grid = {"max_depth": [1, 2], "n_estimators": [5, 10]}
+    params = tcm.search_hyperparameters(denc, data['FINDING_CODE'], 14, grid, cv=2, halving=False, n_jobs=1,
+                                        leaderboard_loc=leaderboard_loc)
+    board = pd.read_csv(leaderboard_loc)
+    assert len(board) == 4
+    assert board["mean_accuracy"].is_monotonic_decreasing
+    assert json.loads(board.loc[0, "params"]) == params
+
+def test_search_hyperparameters_unhappy(caplog):
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    denc, denc2, xenc = tcm.encode_data(data[['SEX_OF_COMPLAINANTS', 'CASE_TYPE']], data[['ASSIGNMENT', 'CASE_TYPE']])
+    with caplog.at_level(logging.ERROR):
+        assert tcm.search_hyperparameters(denc, data['FINDING_CODE'], 14, {"max_iter": [5]}, halving=False,
+                                           n_jobs=1) is None
+    assert "max_iter" in caplog.text
+
+def test_evaluate_model_happy():
+    """Metrics accumulated over chunks match sklearn's on the whole set."""
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    features = ['SEX_OF_COMPLAINANTS', 'AGE_OF_COMPLAINANTS', 'EXCESSIVE_FORCE']
+    denc, denc2, xenc = tcm.encode_data(data[features], data[features])
+    y = data['FINDING_CODE']
+    model = tcm.fit_model(denc, y, 14)
+    metrics = tcm.evaluate_model(model, tcm.held_out_chunks(denc2, y, 4))
+    pred = model.predict(denc2)
+    assert metrics["accuracy"] == pytest.approx(sklearn.metrics.accuracy_score(y, pred))
+    assert metrics["log_loss"] == pytest.approx(sklearn.metrics.log_loss(y, model.predict_proba(denc2)))
+    assert metrics["confusion_matrix"] == sklearn.metrics.confusion_matrix(y, pred, labels=model.classes_).tolist()
+    precision = sklearn.metrics.precision_score(y, pred, labels=model.classes_, average=None, zero_division=0)
+    assert [metrics["classes"][c]["precision"] for c in model.classes_] == pytest.approx(precision)
+
+def test_evaluate_model_unhappy():
+    """True labels the model doesn't know count as wrong, without a log-loss."""
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    features = ['SEX_OF_COMPLAINANTS', 'AGE_OF_COMPLAINANTS', 'EXCESSIVE_FORCE']
+    denc, denc2, xenc = tcm.encode_data(data[features], data[features])
+    model = tcm.fit_model(denc, data['FINDING_CODE'], 14)
+    y = data['FINDING_CODE'].values.copy()
+    y[0] = "unseen"
+    metrics = tcm.evaluate_model(model, tcm.held_out_chunks(denc2, y, 100))
+    assert metrics["classes"]["unseen"]["support"] == 1
+    assert metrics["n"] == len(y) and metrics["log_loss"] is None
+
+def test_permutation_importance_by_feature(tmp_path):
+    """One importance per original feature, the same with a process pool, and codes recovered from the encoding."""
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    features = ['SEX_OF_COMPLAINANTS', 'AGE_OF_COMPLAINANTS', 'EXCESSIVE_FORCE']
+    denc, denc2, xenc = tcm.encode_data(data[features], data[features])
+    model = tcm.fit_model(denc, data['FINDING_CODE'], 14)
+    levels = list(xenc.categories_)
+    codes = tcm.decode_codes(denc2, levels, xenc)
+    assert (tcm.encode_codes(codes, levels, xenc) == denc2.values).all()
+
+    serial = tcm.permutation_importance_by_feature(model, denc2, data['FINDING_CODE'], xenc, features,
+                                                   str(tmp_path / "serial.csv"), n_repeats=3)
+    parallel = tcm.permutation_importance_by_feature(model, denc2, data['FINDING_CODE'], xenc, features,
+                                                     str(tmp_path / "parallel.csv"), n_repeats=3, workers=2)
+    assert sorted(serial["feature"]) == sorted(features)
+    assert (serial["ci_lower"] <= serial["importance_mean"]).all()
+    pd.testing.assert_frame_equal(serial, parallel)
+
+def test_combination_chunks_happy():
+    levels = [["a", "b"], ["x", "y", "z"], [True, False]]
+    chunks = list(tcm.combination_chunks(levels, 5))
+    assert [len(c) for c in chunks] == [5, 5, 2]
+    codes = [tuple(row) for c in chunks for row in c]
+    assert codes == sorted(set(codes))
+    assert len(codes) == 12
+
+def test_unique_data_combinations_happy(tmp_path):
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    features = ['SEX_OF_COMPLAINANTS', 'AGE_OF_COMPLAINANTS', 'EXCESSIVE_FORCE']
+    denc, denc2, xenc = tcm.encode_data(data[features], data[features])
+    model = tcm.fit_model(denc, data['FINDING_CODE'], 14)
+    app_loc = str(tmp_path / "app_data.csv")
+    tcm.unique_data_combinations(data[features], model, xenc, app_loc, chunk_size=4)
+    unique_data = pd.read_csv(app_loc)
+    assert len(unique_data) == len(unique_data[features].drop_duplicates())
+    assert len(unique_data) == data[features].nunique().prod()
+    assert unique_data["pred"].isin(data['FINDING_CODE']).all()
+
+def test_unique_data_combinations_lookup(tmp_path):
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    features = ['SEX_OF_COMPLAINANTS', 'AGE_OF_COMPLAINANTS', 'EXCESSIVE_FORCE']
+    denc, denc2, xenc = tcm.encode_data(data[features], data[features])
+    model = tcm.fit_model(denc, data['FINDING_CODE'], 14)
+    app_loc = str(tmp_path / "app_data.csv")
+    lookup_loc = str(tmp_path / "pred_lookup.npy")
+    tcm.unique_data_combinations(data[features], model, xenc, app_loc, chunk_size=4, lookup_loc=lookup_loc,
+                                 save_proba=True)
+    lookup = PredictionLookup.load(lookup_loc)
+    unique_data = pd.read_csv(app_loc)
+    assert len(lookup) == len(unique_data)
+    for i, row in unique_data.iterrows():
+        assert lookup.combination_id(row[features]) == i
+        assert lookup.predict(row[features]) == row["pred"]
+    assert sum(lookup.predict_proba(unique_data.loc[0, features]).values()) == pytest.approx(1)
+
+    # vectorized scoring matches the lookup and the model (via the reconstructed one-hot encoding)
+    batch = unique_data[features].copy()
+    batch.loc[0, 'SEX_OF_COMPLAINANTS'] = "unseen"
+    labels, valid = lookup.predict_many(batch)
+    assert not valid[0] and labels[0] is None
+    assert (labels[1:] == unique_data["pred"].values[1:]).all()
+    codes = lookup.level_codes(unique_data[features])
+    assert lookup.predict_proba_many(unique_data[features]) == pytest.approx(model.predict_proba(one_hot_codes(codes, lookup.sizes)))
+
+def test_unique_data_combinations_parallel(tmp_path):
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    features = ['SEX_OF_COMPLAINANTS', 'AGE_OF_COMPLAINANTS', 'EXCESSIVE_FORCE']
+    denc, denc2, xenc = tcm.encode_data(data[features], data[features])
+    model = tcm.fit_model(denc, data['FINDING_CODE'], 14)
+    serial_loc = str(tmp_path / "serial.csv")
+    parallel_loc = str(tmp_path / "parallel.csv")
+    tcm.unique_data_combinations(data[features], model, xenc, serial_loc, chunk_size=4)
+    tcm.unique_data_combinations(data[features], model, xenc, parallel_loc, chunk_size=4, workers=2)
+    serial_data = pd.read_csv(serial_loc)
+    parts = dataset_parts(parallel_loc)
+    assert len(parts) == -(-len(serial_data) // 4)
+    parallel_data = pd.concat([pd.read_csv(part) for part in parts], ignore_index=True)
+    pd.testing.assert_frame_equal(parallel_data, serial_data)
+
+def test_train_test_split_parquet(tmp_path):
+    clean_loc = str(tmp_path / "clean_data.parquet")
+    write_table(pd.read_csv("test/test_data.csv"), clean_loc)
+    X_train, X_test, y_train, y_test = tcm.train_test_split(clean_loc, ['ASSIGNMENT', 'CURRENT_CATEGORY'], 'FINDING_CODE', 4, .5)
+    assert X_train.shape[1] == 2
+    assert str(X_train['ASSIGNMENT'].dtype) == "category"
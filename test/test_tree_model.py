@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src import train_copa_model as tcm
+from src.tree_model import TreeModel, export_model
+
+def test_tree_model_happy(tmp_path):
+    """The exported model gives the same probabilities and predictions as the sklearn model."""
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    features = ['SEX_OF_COMPLAINANTS', 'AGE_OF_COMPLAINANTS', 'EXCESSIVE_FORCE']
+    denc, denc2, xenc = tcm.encode_data(data[features], data[features])
+    model = tcm.fit_model(denc, data['FINDING_CODE'], 14)
+    export_model(model, xenc, str(tmp_path / "trees"))
+    tree_model = TreeModel.load(str(tmp_path / "trees"))
+    assert np.allclose(tree_model.predict_proba(data[features]), model.predict_proba(denc2))
+    assert (tree_model.predict(data[features]) == model.predict(denc2)).all()
+
+def test_tree_model_unhappy(tmp_path):
+    """Unseen levels set none of the feature's one-hot columns, as with the encoder's handle_unknown='ignore'."""
+    data = pd.read_csv("test/test_data.csv")
+    data = data.dropna()
+    features = ['SEX_OF_COMPLAINANTS', 'AGE_OF_COMPLAINANTS', 'EXCESSIVE_FORCE']
+    denc, denc2, xenc = tcm.encode_data(data[features], data[features])
+    model = tcm.fit_model(denc, data['FINDING_CODE'], 14)
+    export_model(model, xenc, str(tmp_path / "trees"))
+    tree_model = TreeModel.load(str(tmp_path / "trees"), mmap=False)
+    unseen = data[features].head(3).assign(SEX_OF_COMPLAINANTS="unseen")
+    assert (tree_model.level_codes(unseen)[:, 0] == -1).all()
+    assert tree_model.predict_proba(unseen) == pytest.approx(model.predict_proba(xenc.transform(unseen)))
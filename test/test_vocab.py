@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import OneHotEncoder
+from src import vocab as vc
+
+def test_vocab_happy(tmp_path):
+    """Vocabularies merge over chunks and round-trip, and convert columns to int8-coded categoricals."""
+    data = pd.read_csv("test/test_data.csv")
+    columns = ['SEX_OF_COMPLAINANTS', 'EXCESSIVE_FORCE']
+    vocab = vc.collect_vocab(data.iloc[10:], columns, vc.collect_vocab(data.iloc[:10], columns))
+    assert vocab == vc.collect_vocab(data, columns)
+    assert vocab['EXCESSIVE_FORCE'] == ["False", "True"]
+    vocab_loc = str(tmp_path / "vocab.json")
+    vc.save_vocab(vocab_loc, vocab)
+    assert vc.read_vocab(vocab_loc) == vocab
+
+    coded = vc.apply_vocab(data[columns], vocab)
+    assert coded['SEX_OF_COMPLAINANTS'].cat.codes.dtype == np.int8
+    assert (coded['EXCESSIVE_FORCE'].astype(str) == data['EXCESSIVE_FORCE'].astype(str)).all()
+    assert vc.display_order(["Unknown", "10-14", "5-9", "30+", "0-4"]) == ["0-4", "5-9", "10-14", "30+", "Unknown"]
+
+def test_one_hot_codes_unhappy():
+    """Unknown codes (-1) set no columns, as with OneHotEncoder(handle_unknown='ignore')."""
+    levels = [["a", "b"], ["x", "y", "z"]]
+    enc = OneHotEncoder(categories=levels, handle_unknown='ignore').fit(pd.DataFrame({"f": ["a"], "g": ["x"]}))
+    labels = pd.DataFrame({"f": ["b", "unseen", "a"], "g": ["z", "y", "unseen"]})
+    codes = vc.level_codes(labels, ["f", "g"], levels)
+    assert (codes == np.array([[1, 2], [-1, 1], [0, -1]])).all()
+    assert (vc.one_hot_codes(codes, [2, 3]).toarray() == enc.transform(labels).toarray()).all()